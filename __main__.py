@@ -0,0 +1,134 @@
+# Headless entry point: python -m cocollage render ROOT [FOLDER ...]
+# Never imports Qt. Heavy modules (Pillow, core) are only imported once the arguments are parsed.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# folder containing the scripts, settings.json, templates and data
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_size(value):
+    """ WIDTHxHEIGHT argument """
+
+    try:
+        width, height = [int(v) for v in value.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {value}, expected WIDTHxHEIGHT")
+    return [width, height]
+
+
+def parse_args(argv=None):
+    """ command line arguments """
+
+    parser = argparse.ArgumentParser(prog='cocollage', description="CoCo'llage headless collage renderer")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    render = subparsers.add_parser('render', help='render collages for one or more subfolders of a root folder')
+    render.add_argument('root', help='root folder containing the collage subfolders')
+    render.add_argument('folders', nargs='*', help="subfolders to process (all subfolders not starting with '_' if omitted)")
+    render.add_argument('-t', '--template', default='', help="template id, e.g. T_06_01, or 'auto' for a generated layout (TEMPLATE_DEFAULT if omitted, generated if no template matches the number of pictures)")
+    render.add_argument('-p', '--pictures', nargs='*', default=None, help='picture names to use in each folder (all pictures if omitted)')
+    render.add_argument('--title', default='', help='collage title')
+    render.add_argument('--subtitle', default='', help='collage subtitle')
+    render.add_argument('--time', default='', help='collage time')
+    render.add_argument('--notes', default='', help='collage notes')
+    render.add_argument('-o', '--export-dir', default='', help="export folder ('FOLDER/_out' if omitted)")
+    render.add_argument('-n', '--name', default='', help='picture name ([TITLE], [SUBTITLE], [TIME] and [NOTES] keywords supported)')
+    render.add_argument('--no-description', action='store_true', help='do not draw the description')
+    render.add_argument('--no-logo', action='store_true', help='do not draw the logo')
+    render.add_argument('-q', '--quality', default='', choices=['', 'fast', 'normal', 'high'], help='resampling quality tier (RESAMPLE_QUALITY if omitted)')
+    render.add_argument('-s', '--slot-mode', default='', choices=['', 'fit', 'fill'], help='fit pictures inside their slot or crop them to fill it (SLOT_MODE if omitted)')
+    render.add_argument('-f', '--format', default='', choices=['', 'png', 'jpeg', 'webp'], help='output format (OUTPUT_FORMAT if omitted)')
+    render.add_argument('--sizes', nargs='*', type=parse_size, default=None, help='output sizes rendered from a single decode, e.g. 480x270 1920x1080 3840x2160 (OUTPUT_SIZES if omitted)')
+    render.add_argument('-u', '--skip-unchanged', action='store_true', help='do not render folders unchanged since their last render (SKIP_UNCHANGED if omitted)')
+    render.add_argument('--framing', default=None, help='Edit Mode framing file replayed for all folders (FRAMING_FILE of each folder or of the root if omitted)')
+    render.add_argument('--no-framing', action='store_true', help='ignore the Edit Mode framing files')
+    render.add_argument('-j', '--processes', type=int, default=0, help='number of worker processes (BATCH_PROCESSES if omitted)')
+    render.add_argument('--profile', default=None, help='profile each collage (cProfile and tracemalloc) and write a report of the run in this folder (PROFILE_DIR if omitted)')
+    render.add_argument('-m', '--metrics', default=None, help='JSON-lines file receiving the stage times and counters of each collage (METRICS_FILE if omitted)')
+
+    benchmark = subparsers.add_parser('benchmark', help='time the render stages of every template on synthetic pictures')
+    benchmark.add_argument('-o', '--output', default='benchmark.json', help='results file (benchmark.json if omitted)')
+    benchmark.add_argument('-b', '--baseline', default='', help='results of a previous run, exit code 1 if a case is slower or uses more memory')
+    benchmark.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown/memory increase against the baseline (0.2 = 20%%)')
+    benchmark.add_argument('-t', '--templates', nargs='*', default=None, help='template ids to run (all templates if omitted)')
+    benchmark.add_argument('--profiles', nargs='*', default=None, choices=['jpeg-12mp', 'jpeg-12mp-rotated', 'jpeg-24mp', 'png-4mp'], help='synthetic picture sets (all if omitted)')
+    benchmark.add_argument('-r', '--repeat', type=int, default=3, help='runs per case, the median is kept')
+    benchmark.add_argument('-f', '--format', default='', choices=['', 'png', 'jpeg', 'webp'], help='output format (OUTPUT_FORMAT if omitted)')
+    benchmark.add_argument('-w', '--work-dir', default=os.path.join(tempfile.gettempdir(), 'cocollage_benchmark'), help='folder of the synthetic pictures, kept for the next runs')
+
+    return parser.parse_args(argv)
+
+
+def render(args):
+    """ render collages for the requested folders, returns the process exit code """
+
+    start = time.perf_counter()
+
+    # paths given by the user are relative to where the command was started
+    root = os.path.abspath(args.root)
+    export_dir = os.path.abspath(args.export_dir) if args.export_dir and '[FOLDER]' not in args.export_dir else args.export_dir
+    framing = '' if args.no_framing else os.path.abspath(args.framing) if args.framing else None
+    metrics_file = os.path.abspath(args.metrics) if args.metrics else None
+    profile_dir = os.path.abspath(args.profile) if args.profile else None
+
+    # settings, templates and fonts are relative to the application folder
+    os.chdir(APP_DIR)
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+    from settings import SETTINGS
+    from batch import build_job, make_names_unique
+    from pipeline import BatchRenderer
+    from scheduler import format_duration
+    from folder_index import get_folder_index
+
+    folders = args.folders or [folder for folder in get_folder_index().subfolders(root) if not folder.startswith('_')]
+    template = args.template or SETTINGS['TEMPLATE_DEFAULT']
+
+    jobs = []
+    for folder in folders:
+        folder_path = os.path.join(root, folder)
+        if not os.path.isdir(folder_path):
+            print(f"ERROR: {folder} not a valid folder > Skipped.", file=sys.stderr)
+            continue
+        job = build_job(folder_path, template, title=args.title, subtitle=args.subtitle, Time=args.time, notes=args.notes,
+                        export_dir=export_dir, picture_name=args.name, pictures=args.pictures,
+                        desc=not args.no_description, logo=not args.no_logo, quality=args.quality,
+                        slot_mode=args.slot_mode, output_format=args.format,
+                        output_sizes=args.sizes, skip_unchanged=args.skip_unchanged or SETTINGS.get('SKIP_UNCHANGED', False), framing=framing)
+        if not job.pictures:
+            print(f"ERROR: Pictures not found for batch {folder} > Skipped.", file=sys.stderr)
+            continue
+        jobs.append(job)
+
+    print(f"Startup: {time.perf_counter() - start:.3f}s, rendering {len(jobs)} collage(s)")
+
+    def report(done, total, result, eta):
+        print(f"[{done}/{total}] {result}" + (f" | ETA {format_duration(eta)}" if done < total else ''))
+
+    results = BatchRenderer(args.processes, metrics_file=metrics_file, profile_dir=profile_dir).run(make_names_unique(jobs), report)
+    failed = [result for result in results if not result.ok]
+    skipped = [result for result in results if result.skipped]
+
+    print(f"Done in {time.perf_counter() - start:.2f}s: {len(results) - len(failed) - len(skipped)} collage(s) created, "
+          f"{len(skipped)} unchanged, {len(failed)} failed")
+    return 1 if failed or not results else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'render':
+        return render(args)
+    if args.command == 'benchmark':
+        if APP_DIR not in sys.path:
+            sys.path.insert(0, APP_DIR)
+        from benchmark import run
+        return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
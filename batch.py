@@ -0,0 +1,114 @@
+from core import list_pictures
+from resources import get_settings
+from encoders import get_output_format, output_extension
+from framing import folder_framing
+from datetime import datetime
+import os
+import re
+
+
+class BatchJob():
+    """ Picklable description of one collage to render, built on the UI thread and sent to a worker process """
+
+    def __init__(self, folder, pictures, template, title='', subtitle='', Time='', notes='', export_dir='', picture_name='', show=False, desc=True, logo=True, quality='', slot_mode='', output_format='', output_sizes=None, skip_unchanged=False, framing='', keep_order=False):
+        self.folder = folder
+        self.pictures = pictures
+        self.template = template
+        self.title = title
+        self.subtitle = subtitle
+        self.time = Time
+        self.notes = notes
+        self.export_dir = export_dir
+        self.picture_name = picture_name
+        self.show = show
+        self.desc = desc
+        self.logo = logo
+        self.quality = quality
+        self.slot_mode = slot_mode
+        self.output_format = output_format
+        self.output_sizes = output_sizes
+        self.skip_unchanged = skip_unchanged
+        self.framing = framing
+        self.keep_order = keep_order
+
+    def __repr__(self):
+        """ override print method """
+        return f"BatchJob({self.folder}, {len(self.pictures)} pictures, {self.template})"
+
+
+class BatchResult():
+    """ Outcome of a batch job: output path on success, error message on failure.
+    skipped is True when the inputs did not change since the last render, save_path is then the previous output.
+    metrics is the metrics record of the render (see metrics.py), profile its profile summary when profiled (see profiling.py) """
+
+    def __init__(self, folder, save_path='', error='', duration=0.0, skipped=False, metrics=None, profile=None):
+        self.folder = folder
+        self.save_path = save_path
+        self.error = error
+        self.duration = duration
+        self.skipped = skipped
+        self.metrics = metrics
+        self.profile = profile
+
+    @property
+    def ok(self):
+        return not self.error
+
+    def __repr__(self):
+        """ override print method """
+        if self.skipped:
+            return f"{self.folder} > {self.save_path} (unchanged)"
+        if self.ok:
+            return f"{self.folder} > {self.save_path} ({self.duration:.2f}s)"
+        return f"{self.folder} > ERROR: {self.error}"
+
+
+def build_job(folder, template, title='', subtitle='', Time='', notes='', export_dir='', picture_name='', pictures=None, show=False, desc=True, logo=True, quality='', slot_mode='', output_format='', output_sizes=None, skip_unchanged=False, framing=None):
+    """ build a job from raw field values like the UI does: replace keywords, resolve export folder and picture name.
+    framing is the Edit Mode framing file to replay, found next to the folder if None, not used if '' """
+
+    folder = os.path.normpath(folder)
+    folder_name = os.path.basename(folder)
+    time_now = datetime.now().strftime("%d.%m.%Y, %H:%M:%S")
+
+    # replace keywords in the description fields
+    raw_fields = title, subtitle, Time, notes
+    title, subtitle, Time, notes = [field.replace('[PATH]', folder).replace('[FOLDER]', folder_name).replace('[NOW]', time_now) for field in raw_fields]
+
+    # export folder, '_out' subfolder by default
+    export_dir = export_dir.replace('[FOLDER]', folder) if export_dir else os.path.join(folder, '_out')
+    export_dir = os.path.normpath(export_dir)
+
+    # picture name, default one if not specified
+    if not picture_name:
+        picture_name = f'collage_{time_now}'
+    else:
+        for keyword, field in zip(('[TITLE]', '[SUBTITLE]', '[TIME]', '[NOTES]'), raw_fields):
+            picture_name = picture_name.replace(keyword, field)
+    picture_name = re.sub('[^\w_.)( -]', '_', picture_name)
+
+    # make sure picture is unique
+    extension = output_extension(get_output_format(get_settings(), output_format))
+    if os.path.isfile(os.path.join(export_dir, f'{picture_name}{extension}')):
+        picture_name = re.sub('[^\w_.)( -]', '_', f'{picture_name}_{time_now}')
+
+    if framing is None:
+        framing = folder_framing(folder, get_settings())
+
+    return BatchJob(folder=folder, pictures=list_pictures(folder, pictures), template=template, title=title, subtitle=subtitle,
+                    Time=Time, notes=notes, export_dir=export_dir, picture_name=picture_name, show=show, desc=desc, logo=logo,
+                    quality=quality, slot_mode=slot_mode, output_format=output_format, output_sizes=output_sizes, skip_unchanged=skip_unchanged, framing=framing, keep_order=bool(pictures))
+
+
+def make_names_unique(jobs):
+    """ picture names are resolved up front, make sure two jobs do not write the same file """
+
+    used_names = set()
+    for job in jobs:
+        picture_name, idx = job.picture_name, 1
+        while (job.export_dir, job.picture_name) in used_names:
+            idx += 1
+            job.picture_name = f'{picture_name}_{idx}'
+        used_names.add((job.export_dir, job.picture_name))
+
+    return jobs
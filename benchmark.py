@@ -0,0 +1,228 @@
+from PIL import Image
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+
+# folder containing the scripts, settings.json, templates and data
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# synthetic picture sets: megapixels, file format, EXIF orientation (6: stored landscape, displayed portrait)
+PROFILES = {
+    'jpeg-12mp': (12, 'jpeg', 1),
+    'jpeg-12mp-rotated': (12, 'jpeg', 6),
+    'jpeg-24mp': (24, 'jpeg', 1),
+    'png-4mp': (4, 'png', 1),
+}
+
+# timed stages of a collage render (see metrics.py) and of the template preview
+STAGES = ('template', 'decode', 'orient', 'resize', 'paste', 'text', 'encode', 'write', 'preview')
+
+# regressions smaller than this are measurement noise (seconds per stage, MB of peak memory): a stage must also slow down
+# by MIN_STAGE_SHARE of the case total time, so that a few milliseconds of jitter on a short stage do not fail the run
+MIN_TIME_DELTA = 0.05
+MIN_STAGE_SHARE = 0.05
+MIN_MEMORY_DELTA = 10
+
+
+def make_picture(path, megapixels, file_format, orientation, seed):
+    """ 3:2 picture of gradients and noise (compresses like a photo rather than a flat color) """
+
+    width = round(math.sqrt(megapixels * 1000000 * 3 / 2))
+    height = round(width * 2 / 3)
+    gradient = Image.linear_gradient('L').rotate(seed * 47).resize((width, height))
+    img = Image.merge('RGB', (gradient, Image.effect_noise((width, height), 40), gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x0132] = f'2024:01:01 12:00:{seed % 60:02d}'
+    if file_format == 'jpeg':
+        img.save(path, 'JPEG', quality=90, exif=exif)
+    else:
+        img.save(path, 'PNG', exif=exif)
+
+
+def make_folder(work_dir, profile, count):
+    """ folder of `count` synthetic pictures of a profile, kept in work_dir and reused by the next runs """
+
+    megapixels, file_format, orientation = PROFILES[profile]
+    folder = os.path.join(work_dir, profile)
+    os.makedirs(folder, exist_ok=True)
+    extension = '.jpg' if file_format == 'jpeg' else '.png'
+
+    pictures = [f'pic_{idx:03d}{extension}' for idx in range(count)]
+    for idx, picture in enumerate(pictures):
+        path = os.path.join(folder, picture)
+        if not os.path.isfile(path):
+            make_picture(path, megapixels, file_format, orientation, idx)
+    return folder, pictures
+
+
+def peak_memory_mb():
+    """ peak resident memory of the current process, None where it cannot be measured (Windows) """
+
+    # Linux: high water mark of this process only. ru_maxrss starts at the RSS of the parent at fork time
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(template_id, folder, pictures, output_format, out_dir, repeat):
+    """ render a collage `repeat` times, returns the median time of each stage and the peak memory.
+    Runs in its own process, so the peak memory is the one of this case only """
+
+    os.chdir(APP_DIR)
+    import cache
+    from core import Collage, draw_template_preview
+    from encoders import encode_picture
+    from template_registry import get_registry
+    from settings import SETTINGS
+
+    # the pictures are decoded on every run
+    cache._cache = cache.ThumbnailCache('', 0)
+    template = get_registry(SETTINGS['TEMPLATE_DIR']).get(template_id)
+    pictures = pictures[:template.pic_nb]
+
+    timings = {stage: [] for stage in STAGES}
+    output_bytes = 0
+    for _ in range(repeat):
+        # per picture prints are not part of the measure
+        with contextlib.redirect_stdout(io.StringIO()):
+            # the collage records the time of its own stages
+            collage = Collage(root='', title='Benchmark', subtitle=template_id, Time='12:00', notes='', path=folder, pic_list=pictures)
+            pic_dic = collage.generate_template(template_id)
+
+            collage.set_options(dir=out_dir, name=f'{template_id}_{os.path.basename(folder)}', clipboard=False, output_format=output_format)
+            size = collage.output_sizes[0]
+            images = collage.decode_pictures(collage.scale_pic_dic(pic_dic, size))
+            collage_pic = collage.compose(pic_dic, images, size)
+            data, encode_time = encode_picture(collage_pic, collage.output_format, SETTINGS)
+            collage.write(data, encode_time, False)
+            output_bytes = len(data)
+
+            start = time.perf_counter()
+            draw_template_preview(template)
+            timings['preview'].append(time.perf_counter() - start)
+
+        for stage, seconds in collage.metrics.times.items():
+            timings[stage].append(seconds)
+
+    stages = {stage: statistics.median(values) for stage, values in timings.items()}
+    return {
+        'template': template_id,
+        'pictures': len(pictures),
+        'stages': stages,
+        'total': sum(stages.values()),
+        'peak_memory_mb': peak_memory_mb(),
+        'output_bytes': output_bytes,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ regressions of the results against a baseline: a stage, the total time or the peak memory of a case
+    more than `tolerance` (e.g. 0.2 for 20%) above the baseline. Cases missing from either side are ignored """
+
+    regressions = []
+    for case, result in results['cases'].items():
+        base = baseline.get('cases', {}).get(case)
+        if not base:
+            continue
+
+        min_stage_delta = max(MIN_TIME_DELTA, MIN_STAGE_SHARE * (base.get('total') or 0))
+        measures = [(f'{stage} time', result['stages'][stage], base['stages'].get(stage), min_stage_delta, 's') for stage in STAGES]
+        measures.append(('total time', result['total'], base.get('total'), MIN_TIME_DELTA, 's'))
+        measures.append(('peak memory', result['peak_memory_mb'], base.get('peak_memory_mb'), MIN_MEMORY_DELTA, 'MB'))
+
+        for name, value, base_value, min_delta, unit in measures:
+            if value is None or base_value is None:
+                continue
+            if value > base_value * (1 + tolerance) and value - base_value > min_delta:
+                regressions.append(f"{case}: {name} {base_value:.3f}{unit} > {value:.3f}{unit} (+{(value / base_value - 1) * 100 if base_value else math.inf:.0f}%)")
+
+    return regressions
+
+
+def run(args):
+    """ run the benchmark, returns the process exit code: 1 if a case regressed against the baseline """
+
+    work_dir = os.path.abspath(args.work_dir)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else ''
+
+    os.chdir(APP_DIR)
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    from settings import SETTINGS
+    from template_registry import get_registry
+
+    templates = [template for template in get_registry(SETTINGS['TEMPLATE_DIR']).all() if not args.templates or template.template_id in args.templates]
+    profiles = args.profiles or list(PROFILES)
+    if not templates:
+        print("No template to benchmark.", file=sys.stderr)
+        return 1
+
+    # pictures are generated once, with enough pictures for the biggest template
+    print(f"Preparing synthetic pictures in {work_dir}")
+    folders = {profile: make_folder(work_dir, profile, max(template.pic_nb for template in templates)) for profile in profiles}
+    out_dir = os.path.join(work_dir, '_out')
+
+    results = {
+        'python': platform.python_version(),
+        'pillow': Image.__version__,
+        'platform': platform.platform(),
+        'settings': {key: SETTINGS.get(key) for key in ('COLLAGE_WIDTH', 'COLLAGE_HEIGHT', 'RESAMPLE_QUALITY', 'SLOT_MODE', 'OUTPUT_FORMAT')},
+        'repeat': args.repeat,
+        'cases': {},
+    }
+
+    # a fresh process per case: no memory or cache carried over from the previous one
+    context = multiprocessing.get_context('spawn')
+    for template in templates:
+        for profile in profiles:
+            case = f'{template.template_id}/{profile}'
+            folder, pictures = folders[profile]
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (template.template_id, folder, pictures, args.format, out_dir, args.repeat))
+            results['cases'][case] = result
+
+            stages = ' | '.join(f"{stage} {result['stages'][stage] * 1000:.0f}ms" for stage in STAGES)
+            memory = f"{result['peak_memory_mb']:.0f} MB" if result['peak_memory_mb'] is not None else '-'
+            print(f"{case:32} total {result['total'] * 1000:6.0f}ms | {stages} | peak {memory}")
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved at {output}")
+
+    if not baseline_path:
+        return 0
+
+    try:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read baseline {baseline_path}: {e}", file=sys.stderr)
+        return 1
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    print(f"{len(regressions)} regression(s) against {baseline_path} (tolerance {args.tolerance * 100:.0f}%)")
+    return 1 if regressions else 0
@@ -0,0 +1,176 @@
+from settings import SETTINGS
+from imaging import load_picture, OPAQUE_INFO
+from metrics import current_metrics
+from PIL import Image
+import hashlib
+import os
+
+# the cache can be shared by several processes, each one only counts its own writes: the directory is scanned again
+# after RESCAN_WRITES writes, or once the local count reaches RESCAN_SHARE of the cap, before deciding to evict
+RESCAN_WRITES = 16
+RESCAN_SHARE = 0.8
+
+
+class ThumbnailCache():
+    """ On-disk cache of decoded, upright and resized pictures, with a size cap and LRU eviction.
+    Entries are raw pixels (no encoding cost) keyed by path, mtime, file size, target box, quality tier, slot mode and framing region """
+
+    def __init__(self, cache_dir, max_mb):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.total_bytes = None  # computed on first write
+        self.unscanned_writes = 0   # writes since the last scan of the cache directory
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def entry_path(self, path, box, quality, mode, region=None):
+        """ path of the cache entry of a picture. Changing the picture (mtime/size) changes the entry """
+
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{box[0]}x{box[1]}|{quality}|{mode}|{region}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.raw')
+
+    def get(self, entry):
+        """ return the cached picture or None """
+
+        try:
+            with open(entry, 'rb') as f:
+                # 'opaque' flag after the size for pictures decoded without alpha, absent from older entries
+                mode, width, height, *flags = f.readline().decode('ascii').split()
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # truncated or corrupt entry (interrupted copy, disk full...): removed, the picture is decoded again
+        try:
+            img = Image.frombytes(mode, (int(width), int(height)), data)
+        except ValueError:
+            self.remove(entry)
+            return None
+
+        # touch the entry, the eviction removes the least recently used ones first
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        if OPAQUE_INFO in flags:
+            img.info[OPAQUE_INFO] = True
+        return img
+
+    def put(self, entry, img):
+        """ store a picture. Written to a temp file first, the cache can be shared by several processes """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        flags = f" {OPAQUE_INFO}" if img.info.get(OPAQUE_INFO) else ''
+        header = f"{img.mode} {img.width} {img.height}{flags}\n".encode('ascii')
+        data = img.tobytes()
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        # an entry written again (by another process) replaces the previous one, its size is not added twice
+        try:
+            replaced = os.path.getsize(entry)
+        except OSError:
+            replaced = 0
+        try:
+            with open(tmp_entry, 'wb') as f:
+                f.write(header)
+                f.write(data)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # the eviction only sees complete entries, a partial temp file would never be removed
+            self.remove(tmp_entry)
+            return
+
+        self.unscanned_writes += 1
+        if self.total_bytes is not None:
+            # not read back from the entry, another process may have evicted it already
+            self.total_bytes += len(header) + len(data) - replaced
+
+        # the writes of the other processes are only seen by scanning the directory
+        if self.total_bytes is None or self.unscanned_writes >= RESCAN_WRITES or self.total_bytes > self.max_bytes * RESCAN_SHARE:
+            self.total_bytes = self.size()
+            self.unscanned_writes = 0
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def remove(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+    def entries(self):
+        """ (mtime, size, path) of the complete entries. Entries evicted meanwhile by another process are left out """
+
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.raw'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """ total size of the cache on disk """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ remove least recently used entries until the cache is back under 90% of its cap """
+
+        entries = sorted(self.entries())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        self.unscanned_writes = 0
+
+        for _, size, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def load(self, path, box, quality='high', mode='fit', region=None):
+        """ same as imaging.load_picture, reading from/writing to the cache """
+
+        if not self.enabled:
+            return load_picture(path, box, quality, mode, region)
+
+        entry = self.entry_path(path, box, quality, mode, region)
+        img = self.get(entry)
+        if img is not None:
+            self.hits += 1
+            current_metrics().count('cache_hits')
+            return img
+
+        self.misses += 1
+        img = load_picture(path, box, quality, mode, region)
+        self.put(entry, img)
+        return img
+
+
+# one cache per process
+_cache = None
+
+
+def get_cache():
+    """ process-wide thumbnail cache configured from the settings """
+
+    global _cache
+    if _cache is None:
+        _cache = ThumbnailCache(SETTINGS.get('CACHE_DIR', '_cache'), SETTINGS.get('CACHE_SIZE_MB', 0))
+    return _cache
+
+
+def load_cached_picture(path, box, quality='high', mode='fit', region=None):
+    """ load a picture through the process-wide thumbnail cache """
+    return get_cache().load(path, box, quality, mode, region)
@@ -1,14 +1,27 @@
-from edit import *
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from settings import SETTINGS
+from resources import get_settings, get_font, get_logo
+from cache import load_cached_picture
+from template_registry import scale_box
+from layout import plan_collage, GeneratedTemplate, AUTO_TEMPLATE
+from imaging import fit_size, QUALITY_TIERS, PictureBands, paste_picture
+from encoders import get_output_format, output_extension, canvas_mode, encode_picture, format_size, PngBandWriter
+from framing import read_framing
+from metadata import order_pictures
+from folder_index import get_folder_index
+from metrics import RenderMetrics, recording, write_record
+from PIL import Image, ImageDraw
 from pathlib import Path
+import os
 import re
+import time
 from datetime import datetime
+from random import randint
 
 
 class Collage():
     """ Class describing an image collage """
 
-    def __init__(self, root, title, subtitle, Time, notes, path, pic_list):
+    def __init__(self, root, title, subtitle, Time, notes, path, pic_list, keep_order=False):
         self.root = root
         self.title = title
         self.subtitle = subtitle
@@ -16,9 +29,22 @@ class Collage():
         self.notes = notes
         self.path = path
         self.pic_list = pic_list
+        self.keep_order = keep_order    # specified pictures fill the slots in their order (see layout.plan_collage)
         self.collage_pic_window = None
         self.export_dir = ""
         self.picture_name = ""
+        self.batch = os.path.basename(os.path.normpath(path)) if path else ""
+        self.add_description = True
+        self.add_logo = True
+        self.clipboard = True
+        self.quality = SETTINGS.get('RESAMPLE_QUALITY', 'high')
+        self.slot_mode = SETTINGS.get('SLOT_MODE', 'fit')
+        self.output_format = get_output_format(SETTINGS)
+        self.output_sizes = [(SETTINGS['COLLAGE_WIDTH'], SETTINGS['COLLAGE_HEIGHT'])]
+        self.template_id = ''
+        self.slots = {}         # picture path > slot number in the template
+        self.framing = {}       # slot number > framing region saved from the Edit window
+        self.metrics = RenderMetrics()
 
         # if pic_list empty, raise error
         if not self.pic_list:
@@ -34,107 +60,285 @@ class Collage():
     def generate_template(self, template_id):
         """ generates a template for the collage """
 
-        pic_nb = len(self.pic_list)
-        template_pic_nb = int(template_id.split('_')[1])
+        start = time.perf_counter()
 
-        # if template does not match the number of pictures, find a matching one
-        if pic_nb != template_pic_nb:
-            template_id = f"T_{str(pic_nb).zfill(2)}_01"
-            self.print_to_log("Selected template does not match number of pictures > Looking for a matching template.")
+        # if template does not match the number of pictures, find a matching one, or lay the pictures out in rows
+        template, slots = plan_collage([os.path.join(self.path, pic) for pic in self.pic_list], template_id, SETTINGS, self.keep_order)
 
-        # get path to json file
-        template_id_path = os.path.join(SETTINGS['TEMPLATE_DIR'], template_id + ".json")
+        if isinstance(template, GeneratedTemplate):
+            if template_id != AUTO_TEMPLATE:
+                self.print_to_log(f"No template for {len(self.pic_list)} pictures > Using a generated layout.")
+        elif template.template_id != template_id:
+            self.print_to_log("Selected template does not match number of pictures > Using a matching template.")
+        self.template_id = template.template_id
 
-        # if json file does not exist, raise error
-        if not os.path.isfile(template_id_path):
-            raise OSError("Could not find a matching template json file, create one")
+        # template boxes in pixels for the collage size
+        boxes = template.boxes((SETTINGS['COLLAGE_WIDTH'], SETTINGS['COLLAGE_HEIGHT']))
 
-        # load template file contents
-        with open(f"{os.path.join(SETTINGS['TEMPLATE_DIR'], template_id)}.json") as f:
-            template_layout = json.load(f)
-
-        # store picture paths as keys and get values from json file
+        # store picture paths as keys, in slot order, and get values from the template
         pic_dic = {}
 
-        for idx, pic in enumerate(self.pic_list):
-            pic_path = os.path.join(self.path, pic)
-            pic_dic[pic_path] = tuple(template_layout[str(idx + 1)])
+        for pic_path, slot in slots.items():
+            pic_dic[pic_path] = boxes[str(slot)]
+            self.slots[pic_path] = slot
 
-        # get description values from json file
-        pic_dic['Description'] = tuple(template_layout['Description'])
+        # get description values from the template
+        if 'Description' in boxes:
+            pic_dic['Description'] = boxes['Description']
 
-        # store logo path as key and get values from json file
-        pic_dic[SETTINGS['COCO_LOGO']] = tuple(template_layout['Logo'])
+        # store logo path as key and get values from the template
+        if 'Logo' in boxes:
+            pic_dic[SETTINGS['COCO_LOGO']] = boxes['Logo']
 
+        self.metrics.add('template', time.perf_counter() - start)
         return pic_dic
 
     def collage_auto(self, pic_dic, show_pic):
         """ automatically create and export picture based on a dict of paths and resolution (no ui, no edit) """
 
-        # create empty picture
-        collage_pic = Image.new(mode="RGBA", size=(SETTINGS['COLLAGE_WIDTH'], SETTINGS['COLLAGE_HEIGHT']),
-                               color=tuple(SETTINGS['BKG_COLOR']))
+        start = time.perf_counter()
+
+        # the same stages are overlapped across collages by pipeline.RenderPipeline
+        # pictures are decoded once, for the biggest output size rendered on a full canvas
+        canvas_sizes = [size for size in self.output_sizes if not self.banded(size)]
+        images = self.decode_pictures(self.scale_pic_dic(pic_dic, self.largest_size(canvas_sizes))) if canvas_sizes else {}
+
+        save_paths = []
+        for size in self.output_sizes:
+            # poster sizes are composed and written band by band
+            if self.banded(size):
+                save_paths.append(self.write_bands(pic_dic, size, show_pic and not save_paths))
+                continue
+            collage_pic = self.compose(pic_dic, images, size)
+            data, encode_time = encode_picture(collage_pic, self.output_format, SETTINGS)
+            save_paths.append(self.write(data, encode_time, show_pic and not save_paths, size))
+
+        write_record(SETTINGS.get('METRICS_FILE', ''), self.metrics_record(save_paths[0], time.perf_counter() - start))
+        return save_paths[0]
+
+    def largest_size(self, sizes):
+        return max(sizes, key=lambda size: size[0] * size[1])
+
+    def banded(self, size):
+        """ True if an output size is rendered band by band: PNG bigger than BAND_THRESHOLD_MP megapixels """
+        return self.output_format == 'png' and size[0] * size[1] > SETTINGS.get('BAND_THRESHOLD_MP', 40) * 1000000
+
+    def scale_pic_dic(self, pic_dic, size):
+        """ pic_dic boxes (collage size) scaled to an output size """
+
+        scale_x, scale_y = size[0] / SETTINGS['COLLAGE_WIDTH'], size[1] / SETTINGS['COLLAGE_HEIGHT']
+        return {key: scale_box(value, scale_x, scale_y) if key and value else value for key, value in pic_dic.items()}
+
+    def resize_pictures(self, images, pic_dic):
+        """ decoded pictures reduced to fit the boxes of a smaller output, instead of decoding them again """
+
+        resample, reducing_gap = QUALITY_TIERS.get(self.quality, QUALITY_TIERS['high'])
+        resized = {}
+        with self.metrics.stage('resize'):
+            for key, img in images.items():
+                size = fit_size(img.size, pic_dic[key][2:4])
+                resized[key] = img if size == img.size else img.resize(size, resample, reducing_gap=reducing_gap)
+        return resized
 
-        # paste pictures into it
-        if isinstance(pic_dic, dict):
+    def decode_pictures(self, pic_dic):
+        """ open (reduced on decode or from the thumbnail cache), resize and reorient the pictures and logo, by path """
+
+        images = {}
+        # decode, orient and resize times are recorded by the loaders
+        with recording(self.metrics):
             for key, value in pic_dic.items():
 
-                # data missing or not specified
-                if not (key and value):
+                # data missing, not specified, or description
+                if not (key and value) or key == 'Description':
+                    continue
+
+                pic_w, pic_h = value[2:4]
+
+                # logo converted once per process
+                if key == SETTINGS['COCO_LOGO']:
+                    if self.add_logo:
+                        images[key] = get_logo(key, (pic_w, pic_h))
                     continue
 
-                # get picture resolution and position
-                pic_path = key
-                pic_x, pic_y, pic_w, pic_h = value[0:4]
+                # print key/value of the current picture
+                if SETTINGS.get('VERBOSE', True):
+                    print(key, value)
+                images[key] = load_cached_picture(key, (pic_w, pic_h), self.quality, self.slot_mode, self.framing.get(self.slots.get(key)))
+                self.metrics.count('pictures')
+
+        return images
+
+    def compose(self, pic_dic, images, size=None):
+        """ paste the decoded pictures and write the description on an empty collage of size (collage size by default) """
+
+        # boxes and pictures (decoded for the biggest output) for this size
+        size = size or (SETTINGS['COLLAGE_WIDTH'], SETTINGS['COLLAGE_HEIGHT'])
+        pic_dic = self.scale_pic_dic(pic_dic, size)
+        images = self.resize_pictures(images, pic_dic)
+        text_size = round(SETTINGS['TEXT_SIZE'] * size[1] / SETTINGS['COLLAGE_HEIGHT'])
+
+        # create empty picture, RGB unless the background is transparent and the output format keeps it
+        collage_pic = Image.new(mode=canvas_mode(self.output_format, SETTINGS['BKG_COLOR']), size=tuple(size),
+                               color=tuple(SETTINGS['BKG_COLOR']))
+
+        for key, value in pic_dic.items():
 
-                # Add description if option enabled
-                if key == 'Description':
-                    if self.add_description:
-                        # print key/value of the description
+            # data missing or not specified
+            if not (key and value):
+                continue
+
+            # get picture position
+            pic_x, pic_y = value[0:2]
+
+            # Add description if option enabled
+            if key == 'Description':
+                if self.add_description:
+                    # print key/value of the description
+                    if SETTINGS.get('VERBOSE', True):
                         print(key, value)
+                    with self.metrics.stage('text'):
                         description_text = self.format_description(value[-1])
                         # write description in picture
                         description = ImageDraw.Draw(collage_pic)
                         description.text((pic_x, pic_y), description_text,
-                                        font=ImageFont.truetype(SETTINGS['TEXT_FONT'], SETTINGS['TEXT_SIZE']),
+                                        font=get_font(SETTINGS['TEXT_FONT'], text_size),
                                         fill=tuple(SETTINGS['TEXT_COLOR']))
-                    continue
-                
-                # Add logo if option enabled
-                if key == SETTINGS['COCO_LOGO'] and not self.add_logo:
-                    continue
-                
-                # print key/value of the current picture
-                print(key, value)
+                continue
+
+            # paste pictures (and logo if option enabled) into it
+            if key in images:
+                img = images[key]
+                with self.metrics.stage('paste'):
+                    paste_picture(collage_pic, img, (pic_x, pic_y))
+
+        return collage_pic
+
+    def get_save_path(self, size=None):
+        """ path of the exported picture, suffixed with its size when rendering several sizes """
 
-                # Open, reorient, resize and paste image data into review pic
-                img = Image.open(pic_path).convert("RGBA")
-                img = ImageOps.exif_transpose(img)
-                img.thumbnail((pic_w, pic_h), Image.ANTIALIAS)
-                collage_pic.paste(img, box=(pic_x, pic_y), mask=img)
-        
         # screenshot title
         if self.picture_name:
             title = self.picture_name
         else:
             title = f"{self.batch}_review"
+        if size and len(self.output_sizes) > 1:
+            title = f"{title}_{size[0]}x{size[1]}"
 
         # export dir
         if self.export_dir:
-            save_path = os.path.join(self.export_dir, f'{title}.png')
-        else:
-            save_path = os.path.join(self.path, "export", f'{title}.png')
+            return os.path.join(self.export_dir, f'{title}{output_extension(self.output_format)}')
+        return os.path.join(self.path, "export", f'{title}{output_extension(self.output_format)}')
 
-        Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
+    def write(self, data, encode_time, show_pic, size=None):
+        """ write the encoded picture, add path to clipboard, print result and return the saved path """
+
+        save_path = self.get_save_path(size)
+        self.metrics.add('encode', encode_time)
 
         # save picture, add path to clipboard and print result
-        collage_pic.save(save_path)
-        pyperclip.copy(save_path)
-        print(f"Screenshot saved at {save_path}. Path copied to clipboard.")
+        with self.metrics.stage('write'):
+            Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
+            with open(save_path, 'wb') as f:
+                f.write(data)
+        self.metrics.count('bytes_written', len(data))
+        encode_info = f"{self.output_format.upper()}, {format_size(len(data))}, encoded in {encode_time:.2f}s"
+        return self.saved(save_path, encode_info, show_pic)
+
+    def write_bands(self, pic_dic, size, show_pic):
+        """ compose and encode a PNG collage band by band, straight to disk. Memory depends on BAND_HEIGHT and on the
+        source pictures, not on the output size: each band only resamples the picture rows it contains """
+
+        start = time.perf_counter()
+        save_path = self.get_save_path(size)
+        Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
+
+        pic_dic = self.scale_pic_dic(pic_dic, size)
+        mode = canvas_mode(self.output_format, SETTINGS['BKG_COLOR'])
+        band_height = SETTINGS.get('BAND_HEIGHT', 256)
+        font = get_font(SETTINGS['TEXT_FONT'], round(SETTINGS['TEXT_SIZE'] * size[1] / SETTINGS['COLLAGE_HEIGHT']))
+
+        # pictures are only decoded once a band reaches them, and released after their last band
+        sources = {}
+        for key, value in pic_dic.items():
+            if key and value and key not in ('Description', SETTINGS['COCO_LOGO']):
+                if SETTINGS.get('VERBOSE', True):
+                    print(key, value)
+                self.metrics.count('pictures')
+                sources[key] = PictureBands(key, value[2:4], self.quality, self.slot_mode, self.framing.get(self.slots.get(key)))
+
+        writer = PngBandWriter(save_path, size, mode, SETTINGS.get('PNG_COMPRESS_LEVEL', 6))
+        with recording(self.metrics):
+            try:
+                for top in range(0, size[1], band_height):
+                    bottom = min(top + band_height, size[1])
+                    band = Image.new(mode=mode, size=(size[0], bottom - top), color=tuple(SETTINGS['BKG_COLOR']))
+
+                    for key, value in pic_dic.items():
+                        if not (key and value):
+                            continue
+                        pic_x, pic_y = value[0:2]
+
+                        # text and logo are drawn on every band, clipped to it
+                        if key == 'Description':
+                            if self.add_description:
+                                with self.metrics.stage('text'):
+                                    ImageDraw.Draw(band).text((pic_x, pic_y - top), self.format_description(value[-1]), font=font,
+                                                              fill=tuple(SETTINGS['TEXT_COLOR']))
+                            continue
+                        if key == SETTINGS['COCO_LOGO']:
+                            if self.add_logo:
+                                img = get_logo(key, value[2:4])
+                                if pic_y < bottom and pic_y + img.height > top:
+                                    with self.metrics.stage('paste'):
+                                        paste_picture(band, img, (pic_x, pic_y - top))
+                            continue
+
+                        # picture rows inside the band
+                        source = sources[key]
+                        if source.img is None or pic_y >= bottom:
+                            continue
+                        pic_top, pic_bottom = max(top, pic_y), min(bottom, pic_y + source.size[1])
+                        if pic_top < pic_bottom:
+                            rows = source.rows(pic_top - pic_y, pic_bottom - pic_y)
+                            with self.metrics.stage('paste'):
+                                paste_picture(band, rows, (pic_x, pic_top - top))
+                        if pic_y + source.size[1] <= bottom:
+                            source.close()
+
+                    with self.metrics.stage('encode'):
+                        writer.write(band)
+            finally:
+                writer.close()
+                for source in sources.values():
+                    if source.img is not None:
+                        source.close()
+
+        self.metrics.count('bytes_written', os.path.getsize(save_path))
+        encode_info = f"{self.output_format.upper()} in bands, {format_size(os.path.getsize(save_path))}, rendered in {time.perf_counter() - start:.2f}s"
+        return self.saved(save_path, encode_info, show_pic)
+
+    def metrics_record(self, output, duration, **fields):
+        """ metrics record of this collage (see metrics.py) """
+
+        return self.metrics.record(folder=self.path, template=self.template_id, output=output, format=self.output_format,
+                                   sizes=[list(size) for size in self.output_sizes], duration=round(duration, 6), **fields)
+
+    def saved(self, save_path, encode_info, show_pic):
+        """ add path to clipboard, print result, show picture and return the saved path """
+
+        if self.clipboard:
+            # imported here so headless renders never need a clipboard
+            import pyperclip
+            pyperclip.copy(save_path)
+            print(f"Screenshot saved at {save_path} ({encode_info}). Path copied to clipboard.")
+        else:
+            print(f"Screenshot saved at {save_path} ({encode_info}).")
         # show picture
         if show_pic:
             os.startfile(save_path)
 
+        return save_path
+
     def format_description(self, description):
         """ Format the description """
         
@@ -165,31 +369,105 @@ class Collage():
             pic_dic.pop(SETTINGS['COCO_LOGO'])
 
         # create main window
-        review_pic_window.populate_window(app, pic_dic, self.export_dir, self.picture_name)
+        # the framing is restored in the frames and saved to the folder with the collage
+        framing_path = os.path.join(self.path, SETTINGS.get('FRAMING_FILE', '_framing.json'))
+        review_pic_window.populate_window(app, pic_dic, self.export_dir, self.picture_name, self.template_id, self.framing, framing_path)
         review_pic_window.show()
         review_pic_window.update_pictures()  # needs to be done AFTER showing window
 
 
-    def create_collage(self, app, review_pic_window, pic_dic, show, ui=False, dir='', name='', desc=True, logo=True):
-        """ creates collage with or without Edit interface """
-        
-        self.app = app
+    def set_options(self, dir='', name='', desc=True, logo=True, clipboard=True, quality='', slot_mode='', output_format='', output_sizes=None, framing=''):
+        """ store export and rendering options, empty ones fall back to the settings """
 
         # store export directory and target picture
         self.export_dir = dir
         self.picture_name = name
         self.add_description = desc
         self.add_logo = logo
-        
-        # load latest settings
+        self.clipboard = clipboard
+
+        # load latest settings (only read again when settings.json changes)
         global SETTINGS
-        SETTINGS = load_settings()
+        SETTINGS = get_settings()
+
+        # resampling quality tier: fast/normal/high
+        self.quality = quality or SETTINGS.get('RESAMPLE_QUALITY', 'high')
+        # fit (letterbox) or fill (crop) the picture slots
+        self.slot_mode = slot_mode or SETTINGS.get('SLOT_MODE', 'fit')
+        # png, jpeg or webp
+        self.output_format = get_output_format(SETTINGS, output_format)
+        # [[width, height], ...] rendered from a single decode, the collage size only if empty
+        self.output_sizes = [tuple(size) for size in output_sizes or SETTINGS.get('OUTPUT_SIZES') or [(SETTINGS['COLLAGE_WIDTH'], SETTINGS['COLLAGE_HEIGHT'])]]
+        # pan/zoom saved from the Edit window, used if saved with the same template (call generate_template first)
+        self.framing_path = framing
+        self.framing = read_framing(framing, self.template_id)
+
+    def create_collage(self, app, review_pic_window, pic_dic, show, ui=False, dir='', name='', desc=True, logo=True, clipboard=True, quality='', slot_mode='', output_format='', output_sizes=None, framing=''):
+        """ creates collage with or without Edit interface, returns the saved path when created automatically """
+        
+        self.app = app
+        self.set_options(dir, name, desc, logo, clipboard, quality, slot_mode, output_format, output_sizes, framing)
 
         if ui:
             self.collage_edit(app, review_pic_window, pic_dic)
         else:
-            self.collage_auto(pic_dic, show)
+            return self.collage_auto(pic_dic, show)
 
     def print_to_log(self, string):
         ''' log message to console with time information '''
-        print(f'{datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} >> {string}')
\ No newline at end of file
+        print(f'{datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} >> {string}')
+
+def list_pictures(folder, pictures=None):
+    """ return the full path of the given pictures inside a folder, or of all supported pictures if none are given """
+
+    # get specified pictures or all pictures from the folder (listing cached until the folder changes)
+    files = get_folder_index().listing(folder).files
+    if pictures:
+        pictures_list = [os.path.split(pic)[-1] for pic in pictures if pic]
+    else:
+        pictures_list = [pic for pic in files if pic.lower()[-4:] in SETTINGS['PIC_EXTENSION']]
+
+    # keep valid pictures only
+    paths = [os.path.normpath(os.path.join(folder, pic)) for pic in pictures_list if pic in files]
+
+    # specified pictures keep their order, folder pictures are sorted by name or capture time (PICTURE_ORDER)
+    return paths if pictures else order_pictures(paths, SETTINGS.get('PICTURE_ORDER', 'name'))
+
+
+def draw_template_preview(template):
+    """ picture of the boxes of a template at the collage size: grey pictures, description and logo with their key """
+
+    # create empty picture
+    template_img_width = SETTINGS['COLLAGE_WIDTH']
+    template_img_height = SETTINGS['COLLAGE_HEIGHT']
+
+    # get template boxes in pixels
+    template_layout = template.boxes((template_img_width, template_img_height))
+    template_img = Image.new(mode="RGB", size=(template_img_width, template_img_height), color=tuple(SETTINGS['BKG_COLOR']))
+    frame_color = 255, 255, 255
+    frame_width = 3
+
+    # draw pictures/description/logo positions
+    for key, value in template_layout.items():
+        # data missing or not specified
+        if not (key and value):
+            continue
+
+        pic_x, pic_y, pic_w, pic_h = value[0:4]
+        grey_value = randint(0, 128)  # get random grey value btw 0 and 128 (dark)
+        pic_clr = grey_value, grey_value, grey_value  # convert to RGB
+
+        sub_img = Image.new(mode="RGBA", size=(pic_w, pic_h), color=pic_clr)
+        template_img.paste(sub_img, box=(pic_x, pic_y), mask=sub_img)
+        # add white frame
+        border = ImageDraw.Draw(template_img)
+        border.rectangle([pic_x, pic_y, pic_x + pic_w, pic_y + pic_h], fill=None, outline=frame_color, width=frame_width)
+        # add pic number
+        description = ImageDraw.Draw(template_img)
+        description.text((pic_x + 10, pic_y + 10), key, font=get_font(SETTINGS['TEXT_FONT'], 50), fill=tuple(SETTINGS['TEXT_COLOR']))
+
+    # draw picture frame
+    border = ImageDraw.Draw(template_img)
+    border.rectangle([0, 0, template_img_width - frame_width, template_img_height - frame_width], fill=None, outline=frame_color, width=frame_width)
+
+    return template_img
@@ -1,46 +1,32 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QApplication, QLabel, QVBoxLayout, QMessageBox, QMainWindow
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap, QTransform, QScreen
+from PyQt5.QtGui import QPixmap, QImage
+from settings import SETTINGS
+from cache import load_cached_picture
+from imaging import load_picture
+from encoders import get_output_format, output_extension, qt_quality, format_size
+from framing import write_framing
+import math
 import os  # file management
 import json  # json file management
 import time  # insert date_str and time in file names
-import pyperclip  # copy path to clipboard
-import piexif # for picture orientation infos
 import sys # for exception handling
 
 
-def load_settings():
-    """ load current settings """
-    try:
-        # load settings
-        with open('settings.json') as f:
-            data = json.load(f)
-    except:
-        print("Error loading the settings", sys.exc_info()[0])
-    else:
-        return data
+def load_qimage(path, box, cached=True):
+    """ Load an upright picture fitting inside box (through the thumbnail cache unless cached is False), as a QImage """
 
-SETTINGS = load_settings()
+    img = load_cached_picture(path, box) if cached else load_picture(path, box)
+    data = img.tobytes()
+    # copy the pixels, the QImage does not own data
+    return QImage(data, img.width, img.height, img.width * 4, QImage.Format_RGBA8888).copy()
 
-def get_exif_rotation_angle(path):
-    """" Reads rotation value from exif and returns rotation value required to display picture correctly """
 
-    img_supported = ['.jpg', '.tif']
+def load_pixmap(path, box):
+    """ Load an upright picture fitting inside box through the thumbnail cache, as a QPixmap """
+    return QPixmap.fromImage(load_qimage(path, box))
 
-    if path.lower()[-4:] in img_supported:
-        exif_dict = piexif.load(path)
-        if piexif.ImageIFD.Orientation in exif_dict["0th"]:
-            orientation = exif_dict["0th"].pop(piexif.ImageIFD.Orientation)
-            if orientation == 3:
-                return 180
-            elif orientation == 6:
-                return 90
-            elif orientation == 8:
-                return -90
-
-    # returns 0 (no rotation) for all other values of if img is not supported
-    return 0
 
 class PictureFrame(QtWidgets.QGraphicsView):
     """ Frame displaying a picture or a description and offering zoom/pan/click events """
@@ -50,6 +36,11 @@ class PictureFrame(QtWidgets.QGraphicsView):
         self._picturePath = None
         self._scene = QtWidgets.QGraphicsScene(self)
         self._photo = QtWidgets.QGraphicsPixmapItem()
+        self._photo.setTransformationMode(Qt.SmoothTransformation)
+        self._proxySize = None      # size of the proxy, scene coordinates are proxy pixels
+        self._level = 1             # resolution of the displayed picture, in proxy size multiples
+        self._fullResolution = False
+        self.slot = None            # slot number of the picture in the template, None for description and logo
         self._scene.addItem(self._photo)
         self.setScene(self._scene)
         self._zoom = 0
@@ -71,7 +62,7 @@ class PictureFrame(QtWidgets.QGraphicsView):
 
     def fitInView(self, scale=True):
         """ Fit current photo in frame"""
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self._photo.sceneBoundingRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.hasPhoto():
@@ -86,6 +77,30 @@ class PictureFrame(QtWidgets.QGraphicsView):
                     self.scale(factor, factor)
             self._zoom = 0
 
+    def framing(self):
+        """ Region of the picture visible in the frame, normalized to the picture size (see framing.py) """
+
+        rect = self.viewportTransform().inverted()[0].mapRect(QtCore.QRectF(self.viewport().rect()))
+        width, height = self._proxySize.width(), self._proxySize.height()
+        return [rect.left() / width, rect.top() / height, rect.right() / width, rect.bottom() / height]
+
+    def setFraming(self, region):
+        """ Pan/zoom to show a normalized region of the picture, as saved by framing() """
+
+        self.fitInView()
+        fit_scale = self.transform().m11()
+        width, height = self._proxySize.width(), self._proxySize.height()
+        rect = QtCore.QRectF(region[0] * width, region[1] * height, (region[2] - region[0]) * width, (region[3] - region[1]) * height)
+        viewrect = self.viewport().rect()
+        factor = min(viewrect.width() / rect.width(), viewrect.height() / rect.height())
+
+        self.resetTransform()
+        self.scale(factor, factor)
+        self.centerOn(rect.center())
+        # closest mouse wheel step, so that zooming back to 0 fits the picture again
+        self._zoom = round(math.log(factor / fit_scale, 1.25))
+        self.loadDetail()
+
     def setPhoto(self, path, settings):
         """ Display photo inside a frame """
         self._zoom = 0
@@ -94,9 +109,14 @@ class PictureFrame(QtWidgets.QGraphicsView):
             self._empty = False
             self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
             self.setGeometry(*settings)
-            transform = QTransform().rotate(get_exif_rotation_angle(path))
-            pixmap = QPixmap(path).transformed(transform)
+            # proxy fitting the frame, decoded at reduced size. Higher resolutions are loaded when zooming in
+            ratio = self.devicePixelRatioF()
+            pixmap = load_pixmap(path, (settings[2] * ratio, settings[3] * ratio))
+            self._proxySize = pixmap.size()
+            self._level = 1
+            self._fullResolution = False
             self._photo.setPixmap(pixmap)
+            self._photo.setScale(1)
         else:
             self._empty = True
             self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
@@ -110,6 +130,56 @@ class PictureFrame(QtWidgets.QGraphicsView):
             self.setGeometry(*settings[0:4])
             self._scene.addText(settings[-1], QtGui.QFont(SETTINGS['TEXT_FONT'], SETTINGS['TEXT_SIZE'], QtGui.QFont.Light)).setDefaultTextColor(QtGui.QColor.fromRgb(*SETTINGS['TEXT_COLOR']))
 
+    def loadImage(self, level):
+        """ Picture at `level` times the proxy size, never bigger than the original """
+
+        box = self._proxySize.width() * level, self._proxySize.height() * level
+        # zoomed levels are not worth keeping in the thumbnail cache
+        return load_qimage(self._picturePath, box, cached=False)
+
+    def loadDetail(self):
+        """ Load the picture again at the next power of 2 of the proxy size once zoomed past the displayed resolution """
+
+        needed = self.transform().m11() * self.devicePixelRatioF()
+        if self._fullResolution or needed <= self._level:
+            return
+
+        level = 2 ** math.ceil(math.log2(needed))
+        image = self.loadImage(level)
+        # pictures are never scaled up, the original resolution is reached
+        self._fullResolution = image.width() < self._proxySize.width() * level - 1
+        self._level = level
+
+        # keep scene coordinates in proxy pixels, pan and zoom are unchanged
+        self._photo.setPixmap(QPixmap.fromImage(image))
+        self._photo.setScale(self._proxySize.width() / image.width())
+
+    def renderFrame(self, painter, scale=1):
+        """ Paint the visible content of the frame (with its pan/zoom) at its position in the window.
+        painter is scaled by `scale`, the original picture is loaded again if the export needs more pixels than displayed """
+
+        viewport = self.viewport()
+        target = QtCore.QRectF(viewport.geometry().translated(self.geometry().topLeft()))
+
+        painter.save()
+        painter.setClipRect(target)
+        painter.fillRect(target, self.backgroundBrush())
+        if self._picturePath:
+            # exported pixels per proxy pixel
+            needed = self.transform().m11() * scale
+            if self._fullResolution or needed <= self._level:
+                image = self._photo.pixmap().toImage()
+            else:
+                image = self.loadImage(needed)
+            # scene coordinates are proxy pixels
+            painter.translate(target.topLeft())
+            painter.setTransform(self.viewportTransform(), True)
+            painter.scale(self._proxySize.width() / image.width(), self._proxySize.height() / image.height())
+            painter.drawImage(0, 0, image)
+        else:
+            self.render(painter, target, viewport.rect())
+        painter.restore()
+
     def wheelEvent(self, event):
         """ mouse wheel event to zoom in/out on frame """
         if self.hasPhoto():
@@ -122,6 +192,7 @@ class PictureFrame(QtWidgets.QGraphicsView):
             # allow zooming in and out of picture
             if self._zoom > 0 or self._zoom < 0:
                 self.scale(factor, factor)
+                self.loadDetail()
             elif self._zoom == 0:
                 self.fitInView()
             # else:
@@ -161,21 +232,34 @@ class Window(QMainWindow):
         self._borders = False
         self.export_dir = ''
         self.picture_name = ''
+        self.template_id = ''
+        self.framing = {}
+        self.framing_path = ''
 
-    def populate_window(self, app, pic_dic, export_dir, picture_name):
-        """ Populate main window with frames """
+    def populate_window(self, app, pic_dic, export_dir, picture_name, template_id='', framing=None, framing_path=''):
+        """ Populate main window with frames. framing ({slot number: region}) is restored once the window is shown,
+        the pan/zoom of each slot is saved to framing_path with the collage """
         
         self.picture_frames = []
         self.export_dir = export_dir
         self.picture_name = picture_name
+        self.template_id = template_id
+        self.framing = framing or {}
+        self.framing_path = framing_path
         self.app = app
+        slot = 0
 
         for path, settings in pic_dic.items():
             if path:
-                print(path, settings)
+                if SETTINGS.get('VERBOSE', True):
+                    print(path, settings)
                 new_frame = PictureFrame(self)
                 if path[-4:].lower() in SETTINGS['PIC_EXTENSION']:
                     new_frame.setPhoto(path, settings)
+                    # pictures come first and in template order, then the logo
+                    if path != SETTINGS['COCO_LOGO']:
+                        slot += 1
+                        new_frame.slot = slot
                 elif path == "Description":
                     new_frame.setDescription(settings)
                 self.picture_frames.append(new_frame)
@@ -183,12 +267,33 @@ class Window(QMainWindow):
                     self.batch_dir = os.path.dirname(path)
 
     def update_pictures(self):
-        """" Fit pictures to frame at startup """
+        """" Fit pictures to frame at startup, or restore their saved framing """
         for picture in self.picture_frames:
-            picture.fitInView()
+            if picture.slot in self.framing:
+                picture.setFraming(self.framing[picture.slot])
+            else:
+                picture.fitInView()
+
+    def render_collage(self, scale=1):
+        """ Render the frames offscreen at `scale` times the collage size. Independent of the screen and its scaling """
+
+        collage = QImage(round(SETTINGS['COLLAGE_WIDTH'] * scale), round(SETTINGS['COLLAGE_HEIGHT'] * scale), QImage.Format_RGB32)
+        collage.fill(QtGui.QColor(*SETTINGS['BKG_COLOR']))
+
+        painter = QtGui.QPainter(collage)
+        painter.setRenderHints(QtGui.QPainter.Antialiasing | QtGui.QPainter.TextAntialiasing | QtGui.QPainter.SmoothPixmapTransform)
+        painter.scale(scale, scale)
+        for frame in self.picture_frames:
+            # frame content is inset by the border width, fill the border area first
+            if self._borders:
+                painter.fillRect(QtCore.QRectF(frame.geometry()), QtGui.QColor(*SETTINGS['BORDER_COLOR']))
+            frame.renderFrame(painter, scale)
+        painter.end()
+
+        return collage
 
     def save_collage(self):
-        """ Take screenshot of the main full screen """
+        """ Render the collage offscreen and export it """
         
         # export directory
         if not self.export_dir:
@@ -200,10 +305,28 @@ class Window(QMainWindow):
         # screenshot title and path
         if not self.picture_name:
             self.picture_name = f"collage_{time.strftime('%Y%m%d_%H%M%S')}"
-        save_path = os.path.join(self.export_dir, f"{self.picture_name}.png")
+        output_format = get_output_format(SETTINGS)
+        save_path = os.path.join(self.export_dir, f"{self.picture_name}{output_extension(output_format)}")
         print(save_path)
-        # grab and savescreenshot
-        QScreen.grabWindow(self.app.primaryScreen(), QApplication.desktop().winId()).save(save_path, 'png')
+        # render and save collage, EXPORT_SCALE times the collage size
+        screenshot = self.render_collage(SETTINGS.get('EXPORT_SCALE', 1))
+        start = time.perf_counter()
+        if not screenshot.save(save_path, output_format.upper(), qt_quality(output_format, SETTINGS)):
+            # Qt image plugin missing for this format (e.g. webp)
+            print(f"Could not encode {output_format} > Using png.")
+            output_format = 'png'
+            save_path = os.path.join(self.export_dir, f"{self.picture_name}.png")
+            screenshot.save(save_path, 'PNG', qt_quality(output_format, SETTINGS))
+        print(f"Encoded {output_format.upper()} in {time.perf_counter() - start:.2f}s, {format_size(os.path.getsize(save_path))}")
+
+        # pan/zoom of each picture, replayed by Batch and Live Mode
+        if self.template_id and self.framing_path:
+            self.framing = {frame.slot: frame.framing() for frame in self.picture_frames if frame.slot}
+            try:
+                write_framing(self.framing_path, self.template_id, self.framing)
+                print(f"Framing saved at {self.framing_path}")
+            except OSError as e:
+                print(f"Could not save framing at {self.framing_path}: {e}")
 
         # Messagebox to confirm export and path
         msg = QMessageBox()
@@ -213,6 +336,7 @@ class Window(QMainWindow):
         msg.setStandardButtons(QMessageBox.Ok)
         msg.exec_()
         # add path to clipboard and print result
+        import pyperclip
         pyperclip.copy(save_path)
         print(f"Screenshot saved here:\n{save_path}. Path copied to clipboard. Have a good day :)")
 
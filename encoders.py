@@ -0,0 +1,107 @@
+from PIL import ImageChops
+import io
+import struct
+import time
+import zlib
+
+# output format > (Pillow format, file extension, can store transparency)
+OUTPUT_FORMATS = {
+    'png': ('PNG', '.png', True),
+    'jpeg': ('JPEG', '.jpg', False),
+    'webp': ('WEBP', '.webp', True),
+}
+
+
+def get_output_format(settings, output_format=''):
+    """ requested output format, OUTPUT_FORMAT from the settings otherwise. Unknown formats fall back to png """
+
+    output_format = (output_format or settings.get('OUTPUT_FORMAT', 'png')).lower()
+    output_format = 'jpeg' if output_format == 'jpg' else output_format
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Unknown output format {output_format} > Using png.")
+        return 'png'
+    return output_format
+
+
+def output_extension(output_format):
+    """ file extension of an output format, e.g. '.jpg' """
+    return OUTPUT_FORMATS[output_format][1]
+
+
+def canvas_mode(output_format, bkg_color):
+    """ RGBA only if the background is transparent and the format can store it, RGB is smaller and faster to encode """
+    return 'RGBA' if len(bkg_color) == 4 and OUTPUT_FORMATS[output_format][2] else 'RGB'
+
+
+def encoder_options(output_format, settings):
+    """ Pillow save() options of an output format """
+
+    if output_format == 'jpeg':
+        return {'quality': settings.get('JPEG_QUALITY', 90)}
+    if output_format == 'webp':
+        return {'quality': settings.get('WEBP_QUALITY', 85)}
+    return {'compress_level': settings.get('PNG_COMPRESS_LEVEL', 6)}
+
+
+def qt_quality(output_format, settings):
+    """ quality argument of QImage/QPixmap.save() matching the encoder options (Qt maps PNG quality 0-100 to zlib level 9-0) """
+
+    if output_format == 'png':
+        return round(100 - settings.get('PNG_COMPRESS_LEVEL', 6) * 91 / 9)
+    return encoder_options(output_format, settings)['quality']
+
+
+def encode_picture(img, output_format, settings):
+    """ encode a picture in memory, returns (encoded bytes, encode time in seconds) """
+
+    pil_format = OUTPUT_FORMATS[output_format][0]
+    if not OUTPUT_FORMATS[output_format][2] and img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    img.save(buffer, pil_format, **encoder_options(output_format, settings))
+    return buffer.getvalue(), time.perf_counter() - start
+
+
+class PngBandWriter():
+    """ PNG file written band by band: rows are filtered and compressed as they come, the whole picture is never in memory """
+
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, path, size, mode, compress_level=6):
+        self.file = open(path, 'wb')
+        self.bands = len(mode)
+        self.compressor = zlib.compressobj(compress_level)
+        self.file.write(self.SIGNATURE)
+        # 8 bits per channel, truecolor (2) or truecolor with alpha (6)
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 6 if mode == 'RGBA' else 2, 0, 0, 0))
+
+    def chunk(self, tag, data):
+        self.file.write(struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data)))
+
+    def write(self, band):
+        """ append a band of rows (RGB or RGBA image of the picture width) """
+
+        # Sub filter: each byte minus the same channel of the previous pixel, done by Pillow
+        previous = ImageChops.offset(band, 1, 0)
+        previous.paste((0,) * self.bands, (0, 0, 1, band.height))
+        data = ImageChops.subtract_modulo(band, previous).tobytes()
+
+        # filter type byte at the start of each row
+        stride = band.width * self.bands
+        rows = b''.join(b'\x01' + data[idx:idx + stride] for idx in range(0, len(data), stride))
+
+        compressed = self.compressor.compress(rows)
+        if compressed:
+            self.chunk(b'IDAT', compressed)
+
+    def close(self):
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        self.file.close()
+
+
+def format_size(size):
+    """ human readable file size """
+    return f"{size / 1024 / 1024:.2f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
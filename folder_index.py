@@ -0,0 +1,86 @@
+import os
+import time
+
+
+class FolderListing():
+    """ Entries of a directory read with a single scandir: subfolder names and {file name: (size, mtime)} """
+
+    def __init__(self, path, mtime, folders, files, settled):
+        self.path = path
+        self.mtime = mtime
+        self.folders = folders
+        self.files = files
+        # False if the directory changed too recently to trust its mtime (coarse mtime resolution on network shares)
+        self.settled = settled
+
+
+class FolderIndex():
+    """ Cached directory listings, read again only when the mtime of a directory changes.
+    A listing costs a single stat while its directory is unchanged, instead of a listdir and a stat per file.
+    Adding, removing or renaming entries changes the mtime of a directory, modifying a file in place does not:
+    use force to follow files being written """
+
+    # directories modified less than this many seconds before being listed are listed again on the next call
+    SETTLE_TIME = 2.0
+
+    def __init__(self):
+        self.listings = {}  # normalized path > FolderListing
+
+    def listing(self, directory, force=False):
+        """ listing of a directory, raises OSError if it cannot be read """
+
+        directory = os.path.normpath(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        known = self.listings.get(directory)
+        if known and known.mtime == mtime and known.settled and not force:
+            return known
+
+        folders, files = [], {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # types come from the directory entries, only files are stat'ed
+                if entry.is_dir():
+                    folders.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = stat.st_size, stat.st_mtime_ns
+
+        settled = time.time() - mtime / 1e9 > self.SETTLE_TIME
+        listing = FolderListing(directory, mtime, sorted(folders), dict(sorted(files.items())), settled)
+        self.listings[directory] = listing
+        return listing
+
+    def subfolders(self, directory):
+        """ sorted names of the subfolders of a directory """
+        return self.listing(directory).folders
+
+    def pictures(self, directory, extensions):
+        """ sorted names of the files of a directory with one of the extensions (e.g. '.jpg') """
+        return [name for name in self.listing(directory).files if name.lower()[-4:] in extensions]
+
+    def has_pictures(self, directory, extensions):
+        """ True if the directory directly contains at least one picture, False if it cannot be read """
+        try:
+            return any(name.lower()[-4:] in extensions for name in self.listing(directory).files)
+        except OSError:
+            return False
+
+    def is_file(self, path):
+        """ True if path is a file of its directory, from the listing of the directory """
+        try:
+            return os.path.basename(path) in self.listing(os.path.dirname(os.path.abspath(path))).files
+        except OSError:
+            return False
+
+
+# one index per process
+_index = None
+
+
+def get_folder_index():
+    """ process-wide folder index """
+
+    global _index
+    if _index is None:
+        _index = FolderIndex()
+    return _index
@@ -0,0 +1,59 @@
+from datetime import datetime
+import json
+import os
+
+# Pan/zoom of the Edit Mode picture frames, saved next to the pictures and replayed by the Pillow renderer.
+# Each slot stores the region of its picture visible in the frame, normalized to the upright picture size:
+# [left, top, right, bottom], values outside 0-1 when the picture does not cover the frame (zoomed out)
+
+
+def find_framing(folder, name):
+    """ framing file of a folder, the one of its parent folder otherwise (shared by all its subfolders), '' if none """
+
+    for path in (os.path.join(folder, name), os.path.join(os.path.dirname(os.path.normpath(folder)), name)):
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+    return ''
+
+
+def read_framing(path, template_id):
+    """ {slot number: region} of a framing file saved with the same template, {} otherwise """
+
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        slots = {int(slot): [float(value) for value in region] for slot, region in data['slots'].items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Invalid framing file {path} > Ignored: {e}")
+        return {}
+
+    if data.get('template') != template_id:
+        print(f"Framing file {path} was saved for template {data.get('template')}, not {template_id} > Ignored.")
+        return {}
+
+    return {slot: region for slot, region in slots.items() if len(region) == 4 and region[0] < region[2] and region[1] < region[3]}
+
+
+def write_framing(path, template_id, slots):
+    """ save the framing of a collage: {slot number: [left, top, right, bottom]} """
+
+    data = {
+        'template': template_id,
+        'saved': datetime.now().isoformat(timespec='seconds'),
+        'slots': {str(slot): [round(value, 6) for value in region] for slot, region in sorted(slots.items())},
+    }
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def folder_framing(folder, settings):
+    """ framing file replayed for a folder, '' if there is none or APPLY_FRAMING is disabled """
+
+    if not settings.get('APPLY_FRAMING', True):
+        return ''
+    return find_framing(folder, settings.get('FRAMING_FILE', '_framing.json'))
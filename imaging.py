@@ -0,0 +1,350 @@
+from metadata import get_index
+from metrics import current_metrics
+from PIL import Image
+import math
+import os
+
+# transposition displaying each EXIF orientation upright (same as ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Image.info key of pictures decoded without alpha, kept by resize, convert and transpose: they are pasted without blending
+OPAQUE_INFO = 'opaque'
+
+# resampling filter and reducing gap for each quality tier. 'high' is a plain LANCZOS resize: the reducing gap of
+# Image.thumbnail was never applied before, Pillow resizes RGBA pictures without it. Pixels only differ from before for
+# JPEG pictures, decoded at a reduced DCT scale (see load_picture)
+QUALITY_TIERS = {
+    'fast': (Image.Resampling.BILINEAR, 1.0),
+    'normal': (Image.Resampling.BICUBIC, 2.0),
+    'high': (Image.Resampling.LANCZOS, None),
+}
+
+# support radius of the resampling filters, in source pixels at scale 1 (as in Pillow's resize)
+FILTER_SUPPORT = {
+    Image.Resampling.BOX: 0.5,
+    Image.Resampling.BILINEAR: 1.0,
+    Image.Resampling.HAMMING: 1.0,
+    Image.Resampling.BICUBIC: 2.0,
+    Image.Resampling.LANCZOS: 3.0,
+}
+
+
+def fit_size(size, box):
+    """ size of an image scaled down to fit inside box, keeping aspect ratio. Rounds like Image.thumbnail """
+
+    width, height = size
+    x, y = map(math.floor, box)
+
+    # never scale pictures up
+    if x >= width and y >= height:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+
+    return x, y
+
+
+def fill_crop(size, box):
+    """ centered region (left, upper, right, lower) of an image with the aspect ratio of box, and the scale filling box with it """
+
+    width, height = size
+    scale = max(box[0] / width, box[1] / height)
+    crop_w, crop_h = box[0] / scale, box[1] / scale
+    left, upper = (width - crop_w) / 2, (height - crop_h) / 2
+
+    # clipped to the image: the crop of the filled side can be off by a rounding error (-1e-13)
+    return (max(left, 0), max(upper, 0), min(left + crop_w, width), min(upper + crop_h, height)), scale
+
+
+def frame_placement(size, box, region):
+    """ region of an image (left, upper, right, lower) shown in box for a normalized framing region (see framing.py),
+    clipped to the image, its destination (x, y, width, height) inside box and the scale """
+
+    width, height = size
+    x0, y0, x1, y1 = region[0] * width, region[1] * height, region[2] * width, region[3] * height
+    scale_x, scale_y = box[0] / (x1 - x0), box[1] / (y1 - y0)
+
+    # parts of the region outside the picture stay empty (transparent)
+    crop = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    left, top = round((crop[0] - x0) * scale_x), round((crop[1] - y0) * scale_y)
+    dest = left, top, round((crop[2] - x0) * scale_x) - left, round((crop[3] - y0) * scale_y) - top
+
+    return crop, dest, max(scale_x, scale_y)
+
+
+def decode(img, path):
+    """ decode an opened picture (reduced if draft was called) to RGB or RGBA, recording the bytes read and pixels decoded """
+
+    metrics = current_metrics()
+    with metrics.stage('decode'):
+        img.load()
+        # palette/greyscale/cmyk pictures are converted before resampling (cheap after draft)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        if img.mode == 'RGB':
+            img.info[OPAQUE_INFO] = True
+    metrics.count('bytes_read', os.path.getsize(path))
+    metrics.count('pixels_decoded', img.width * img.height)
+    return img
+
+
+def is_opaque(img):
+    """ True if img has no transparent pixel: no alpha band, decoded without alpha, or alpha 255 everywhere """
+
+    if 'A' not in img.getbands() or img.info.get(OPAQUE_INFO):
+        return True
+    return img.getchannel('A').getextrema()[0] == 255
+
+
+def paste_picture(canvas, img, position):
+    """ paste img on canvas at position (x, y), blended by its alpha only if it has transparent pixels (logo, PNG...).
+    Opaque pictures are copied as is, which gives the same bytes as a paste masked by an alpha of 255 """
+
+    if is_opaque(img):
+        canvas.paste(img, position)
+    else:
+        canvas.paste(img, position, mask=img)
+
+
+def transpose(img, orientation):
+    """ picture displayed upright for an EXIF orientation """
+
+    if orientation not in ORIENTATION_TRANSPOSE:
+        return img
+    with current_metrics().stage('orient'):
+        return img.transpose(ORIENTATION_TRANSPOSE[orientation])
+
+
+def reduce_for_resize(img, size, box, resample, reducing_gap):
+    """ the integer reduction Image.resize(size, resample, box, reducing_gap) starts with, and the box in the reduced image.
+    Resizing parts of the box from the result (reducing_gap None) gives the same pixels as resizing the whole box at once,
+    where resizing each part with reducing_gap would reduce blocks aligned on the part instead """
+
+    # Pillow resizes RGBA premultiplied, without reduction
+    if reducing_gap is None or resample not in FILTER_SUPPORT or img.mode in ('LA', 'RGBA'):
+        return img, box
+    factor_x = int((box[2] - box[0]) / size[0] / reducing_gap) or 1
+    factor_y = int((box[3] - box[1]) / size[1] / reducing_gap) or 1
+    if factor_x == 1 and factor_y == 1:
+        return img, box
+
+    # box expanded by the pixels the filter reads around it
+    support_x = (FILTER_SUPPORT[resample] - 0.5) * (box[2] - box[0]) / size[0]
+    support_y = (FILTER_SUPPORT[resample] - 0.5) * (box[3] - box[1]) / size[1]
+    reduce_box = (max(0, int(box[0] - support_x)), max(0, int(box[1] - support_y)),
+                  min(img.width, math.ceil(box[2] + support_x)), min(img.height, math.ceil(box[3] + support_y)))
+    img = img.reduce((factor_x, factor_y), box=reduce_box)
+    box = ((box[0] - reduce_box[0]) / factor_x, (box[1] - reduce_box[1]) / factor_y,
+           (box[2] - reduce_box[0]) / factor_x, (box[3] - reduce_box[1]) / factor_y)
+    return img, box
+
+
+def load_framed(img, path, orientation, box, region, resample, reducing_gap):
+    """ region of an opened picture scaled to box, in RGBA, transparent where the region is outside the picture """
+
+    width, height = img.size
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    crop, dest, scale = frame_placement((width, height), box, region)
+
+    # reduce on decode (JPEG only) as long as the region still covers the box, the scale is the same in both orientations
+    img.draft(None, (max(math.ceil(img.width * scale), 1), max(math.ceil(img.height * scale), 1)))
+    img = decode(img, path)
+    # the region is given upright, reorient the reduced picture first
+    img = transpose(img, orientation)
+
+    with current_metrics().stage('resize'):
+        framed = Image.new('RGBA', tuple(box), (0, 0, 0, 0))
+        if dest[2] > 0 and dest[3] > 0:
+            ratio_x, ratio_y = img.width / width, img.height / height
+            crop = crop[0] * ratio_x, crop[1] * ratio_y, crop[2] * ratio_x, crop[3] * ratio_y
+            framed.paste(img.resize(dest[2:], resample, box=crop, reducing_gap=reducing_gap).convert('RGBA'), dest[:2])
+
+    return framed
+
+
+def load_picture(path, box, quality='high', mode='fit', region=None):
+    """ open a picture resized to box (w, h), upright and in RGBA. 'fit' scales it down to fit inside box,
+    'fill' crops it to the aspect ratio of box and scales it to cover box entirely.
+    A framing region (see framing.py) overrides the mode: the region is scaled to box, like in the Edit window.
+    JPEG files are decoded straight at the smallest DCT scale at or above the target size """
+
+    resample, reducing_gap = QUALITY_TIERS.get(quality, QUALITY_TIERS['high'])
+
+    # only the header is read at this point, orientation is shared with the metadata index
+    img = Image.open(path)
+    orientation = get_index().get(path, img).orientation
+
+    if region:
+        return load_framed(img, path, orientation, box, region, resample, reducing_gap)
+
+    # the box is given upright, the picture is stored before rotation
+    box_w, box_h = box
+    if orientation in (5, 6, 7, 8):
+        box_w, box_h = box_h, box_w
+
+    # crop box and target size are computed from the header only, before decoding
+    if mode == 'fill':
+        # the crop is centered, so it is the same in stored and upright orientation
+        full_size = img.size
+        crop, scale = fill_crop(full_size, (box_w, box_h))
+        target = box_w, box_h
+        # reduce on decode (JPEG only) as long as the cropped region still covers the slot
+        img.draft(None, (max(math.ceil(full_size[0] * scale), 1), max(math.ceil(full_size[1] * scale), 1)))
+        ratio_x, ratio_y = img.width / full_size[0], img.height / full_size[1]
+        crop = crop[0] * ratio_x, crop[1] * ratio_y, crop[2] * ratio_x, crop[3] * ratio_y
+    else:
+        crop = None
+        target = fit_size(img.size, (box_w, box_h))
+        # reduce on decode (JPEG only, no-op for other formats)
+        img.draft(None, target)
+
+    img = decode(img, path)
+
+    # only the cropped region is resampled
+    with current_metrics().stage('resize'):
+        if img.size != target or crop:
+            img = img.resize(target, resample, box=crop, reducing_gap=reducing_gap)
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+
+    # reorient the small picture rather than the full one
+    return transpose(img, orientation)
+
+
+class PictureBands():
+    """ A picture placed in a box like load_picture does, resampled one band of rows at a time.
+    Only the header is read until the first band is requested, the source is then decoded (reduced for JPEG) once.
+    As in load_picture, a framing region is resampled from the upright source, otherwise the source is resampled in its
+    stored orientation and each band reoriented: the rows of an upright band are rows or columns of the stored picture """
+
+    def __init__(self, path, box, quality='high', mode='fit', region=None):
+        self.path = path
+        self.resample, self.reducing_gap = QUALITY_TIERS.get(quality, QUALITY_TIERS['high'])
+        self.img = Image.open(path)
+        self.orientation = get_index().get(path, self.img).orientation
+        self.framed = bool(region)
+        rotated = self.orientation in (5, 6, 7, 8)
+
+        if region:
+            # upright size of the source, placed size and region of the source covering it (see load_framed)
+            width, height = self.img.size
+            if rotated:
+                width, height = height, width
+            self.size = tuple(box)
+            self.crop, self.dest, scale = frame_placement((width, height), box, region)
+            self.full_size = width, height
+            draft_size = max(math.ceil(self.img.width * scale), 1), max(math.ceil(self.img.height * scale), 1)
+        else:
+            # same target and crop as load_picture, in stored orientation: the box is given upright
+            box_w, box_h = box
+            if rotated:
+                box_w, box_h = box_h, box_w
+            self.full_size = self.img.size
+            if mode == 'fill':
+                self.crop, scale = fill_crop(self.full_size, (box_w, box_h))
+                self.target = box_w, box_h
+                draft_size = max(math.ceil(self.img.width * scale), 1), max(math.ceil(self.img.height * scale), 1)
+            else:
+                self.target = fit_size(self.full_size, (box_w, box_h))
+                self.crop = 0, 0, *self.full_size
+                draft_size = self.target
+            # placed (upright) size
+            self.size = (self.target[1], self.target[0]) if rotated else self.target
+
+        # reduce on decode (JPEG only), given in stored orientation
+        self.img.draft(None, draft_size)
+        self.loaded = False
+
+    def load(self):
+        """ decode the source (reoriented for a framing region only), and scale the crop region to the decoded size """
+
+        img = decode(self.img, self.path)
+        if self.framed:
+            img = transpose(img, self.orientation)
+
+        ratio_x, ratio_y = img.width / self.full_size[0], img.height / self.full_size[1]
+        self.crop = self.crop[0] * ratio_x, self.crop[1] * ratio_y, self.crop[2] * ratio_x, self.crop[3] * ratio_y
+
+        # reduced once for the whole placed picture, the bands are then resampled without reducing gap
+        size = self.dest[2:] if self.framed else self.target
+        if size[0] > 0 and size[1] > 0:
+            with current_metrics().stage('resize'):
+                img, self.crop = reduce_for_resize(img, size, self.crop, self.resample, self.reducing_gap)
+        self.reducing_gap = None
+        self.img = img
+        self.loaded = True
+
+    def rows(self, top, bottom):
+        """ rows [top, bottom) of the placed picture, in RGBA """
+
+        if not self.loaded:
+            self.load()
+        if self.framed:
+            return self.framed_rows(top, bottom)
+
+        # region of the stored target (load_picture resize) shown upright in rows [top, bottom):
+        # rows or columns, counted from the other side if the orientation flips them
+        target_w, target_h = self.target
+        left, right, upper, lower = 0, target_w, 0, target_h
+        if self.orientation in (1, 2):
+            upper, lower = top, bottom
+        elif self.orientation in (3, 4):
+            upper, lower = target_h - bottom, target_h - top
+        elif self.orientation in (5, 6):
+            left, right = top, bottom
+        else:
+            left, right = target_w - bottom, target_w - top
+
+        # same sampling positions as resizing the whole crop region at once (up to float rounding, +-1 level at most)
+        crop_left, crop_upper, crop_right, crop_lower = self.crop
+        position = lambda start, end, offset, length: start if offset == 0 else end if offset == length else start + offset * (end - start) / length
+        box = (position(crop_left, crop_right, left, target_w), position(crop_upper, crop_lower, upper, target_h),
+               position(crop_left, crop_right, right, target_w), position(crop_upper, crop_lower, lower, target_h))
+        with current_metrics().stage('resize'):
+            rows = self.img.resize((right - left, lower - upper), self.resample, box=box, reducing_gap=self.reducing_gap)
+            if rows.mode != 'RGBA':
+                rows = rows.convert('RGBA')
+        return transpose(rows, self.orientation)
+
+    def framed_rows(self, top, bottom):
+        """ rows [top, bottom) of a framing region, resampled from the upright source like load_framed """
+
+        # same sampling positions as resizing the whole crop region at once (up to float rounding, +-1 level at most)
+        left, upper, right, lower = self.crop
+        dest_x, dest_y, dest_w, dest_h = self.dest
+        dest_top, dest_bottom = max(top, dest_y), min(bottom, dest_y + dest_h)
+        if dest_w <= 0 or dest_top >= dest_bottom:
+            return Image.new('RGBA', (self.size[0], bottom - top), (0, 0, 0, 0))
+
+        scale_y = (lower - upper) / dest_h
+        box = left, upper + (dest_top - dest_y) * scale_y, right, upper + (dest_bottom - dest_y) * scale_y
+        with current_metrics().stage('resize'):
+            rows = self.img.resize((dest_w, dest_bottom - dest_top), self.resample, box=box, reducing_gap=self.reducing_gap).convert('RGBA')
+        if rows.size == (self.size[0], bottom - top):
+            return rows
+
+        # framing region not covering the whole box
+        band = Image.new('RGBA', (self.size[0], bottom - top), (0, 0, 0, 0))
+        band.paste(rows, (dest_x, dest_top - top))
+        return band
+
+    def close(self):
+        """ release the decoded source """
+        self.img.close()
+        self.img = None
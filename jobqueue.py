@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from batch import make_names_unique
+from pipeline import PipelinePool, format_stats
+from metrics import write_record
+from profiling import write_report
+from scheduler import estimate_job
+from resources import get_settings
+import os
+import threading
+import time
+
+
+class JobQueue():
+    """ Queue of render jobs between detection and rendering, drained by render pipelines in a pool of processes.
+    - bounded concurrency: at most two jobs per process are in the pipelines, one decoding while the other one is encoded
+    - backpressure: submit() blocks while `max_pending` jobs are queued or rendering
+    - dedupe: a folder is queued once; if it changes while rendering, it is rendered once more afterwards
+    - memory admission: a job starts once its estimated memory fits in memory_budget (bytes) with the running ones,
+      or when nothing else is running (see scheduler.py)
+    on_done(job, result) is called from a pool thread, it must not touch Qt widgets.
+    The metrics record of each result is appended to metrics_file, if any. With a profile_dir, jobs are profiled
+    and a report of all jobs is written there when the queue is closed (see profiling.py) """
+
+    def __init__(self, processes=0, max_pending=0, on_done=None, depth=2, metrics_file='', profile_dir='', profile_top=20, memory_budget=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.capacity = self.processes * 2
+        self.max_pending = max(max_pending or self.processes * 4, self.capacity)
+        self.on_done = on_done
+        self.metrics_file = metrics_file
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+        self.profiles = {}  # folder > profile summary of its latest render
+        self.memory_budget = memory_budget
+        self.memory = {}    # folder > estimated memory of its queued or running job
+        self.pool = PipelinePool(self.processes, depth, on_done=self.done, profile_dir=profile_dir)
+        self.started = time.perf_counter()
+        self.queued = OrderedDict()  # folder > job waiting for a worker
+        self.running = {}            # folder > job being rendered
+        self.rerun = {}              # folder > (job, memory) submitted again while rendering
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.queued) + len(self.running)
+
+    def submit(self, job, timeout=None):
+        """ queue a job, blocking while the queue is full. Returns False if it could not be queued in time """
+
+        # picture headers are read outside of the lock
+        memory = estimate_job(job, get_settings()).memory if self.memory_budget else 0
+
+        with self.condition:
+            # repeated event for a folder already waiting: keep the latest job only
+            if job.folder in self.queued:
+                self.queued[job.folder] = job
+                self.memory[job.folder] = memory
+                return True
+
+            # folder changed while rendering: render it again once done
+            if job.folder in self.running:
+                self.rerun[job.folder] = job, memory
+                return True
+
+            # backpressure
+            if not self.condition.wait_for(lambda: self.closed or len(self.queued) + len(self.running) < self.max_pending, timeout):
+                return False
+            if self.closed:
+                return False
+
+            # names are resolved when jobs are built, do not let two pending jobs write the same file
+            pending_jobs = list(self.queued.values()) + list(self.running.values())
+            make_names_unique(pending_jobs + [job])
+
+            self.queued[job.folder] = job
+            self.memory[job.folder] = memory
+            self.dispatch()
+            return True
+
+    def dispatch(self):
+        """ start queued jobs while workers and memory are available. Called with the lock held """
+
+        while self.queued and len(self.running) < self.capacity:
+            folder = next(iter(self.queued))
+            reserved = sum(self.memory.get(running, 0) for running in self.running)
+            if self.running and self.memory_budget and reserved + self.memory[folder] > self.memory_budget:
+                break
+            folder, job = self.queued.popitem(last=False)
+            self.running[folder] = job
+            self.pool.submit(folder, job)
+
+    def done(self, folder, result):
+        """ pool callback: collect the result and start the next jobs """
+
+        write_record(self.metrics_file, result.metrics)
+        if result.profile:
+            self.profiles[folder] = result.profile
+        with self.condition:
+            job = self.running.pop(folder)
+            self.memory.pop(folder, None)
+            if job.folder in self.rerun and not self.closed:
+                self.queued[job.folder], self.memory[job.folder] = self.rerun.pop(job.folder)
+            if not self.closed:
+                self.dispatch()
+            self.condition.notify_all()
+
+        if self.on_done:
+            self.on_done(job, result)
+
+    def join(self, timeout=None):
+        """ wait until all queued and running jobs are done """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queued and not self.running, timeout)
+
+    def close(self):
+        """ drop queued jobs, wait for running ones and stop the pool """
+
+        with self.condition:
+            self.closed = True
+            self.queued.clear()
+            self.rerun.clear()
+            self.condition.notify_all()
+        self.pool.close()
+        print(format_stats(self.pool.stats, time.perf_counter() - self.started))
+        if self.profile_dir:
+            report_path = write_report(self.profile_dir, list(self.profiles.values()), self.profile_top)
+            if report_path:
+                print(f"Profile report saved at {report_path}")
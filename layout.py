@@ -0,0 +1,180 @@
+from template_registry import Template, get_registry
+from metadata import get_index
+
+# template id laying out the pictures in justified rows even if a template matches their number
+AUTO_TEMPLATE = 'auto'
+
+# bottom strip of generated layouts (fractions of the collage size), as in the bundled templates: description, then logo on the right
+STRIP_HEIGHT = 120 / 1080
+LOGO_WIDTH = 300 / 1920
+DESCRIPTION_FORMAT = '{title} / {subtitle} / {time} / {notes}'
+
+# aspect ratio of the pictures whose header cannot be read
+DEFAULT_ASPECT = 3 / 2
+
+# binary search steps on the row height, each one lays out all the pictures once
+SEARCH_STEPS = 40
+# row heights tried after the bisection: the collage height divided by 1 to ROW_COUNTS
+ROW_COUNTS = 32
+# up to this many pictures, every split of the pictures in rows is tried (2^(n-1) layouts)
+EXHAUSTIVE_PICTURES = 10
+
+
+class GeneratedTemplate(Template):
+    """ Layout computed for the aspect ratios of a set of pictures (see justified_rows), normalized boxes like a template file """
+
+    def __init__(self, layout, pic_nb):
+        self.template_id = f'{AUTO_TEMPLATE}_{pic_nb:02d}'
+        self.path = ''
+        self.mtime = 0
+        self.layout = layout
+        self.pic_nb, self.variant = pic_nb, 0
+
+
+def break_rows(aspects, width, row_height):
+    """ pictures (indexes) of each row for a target row height. Once the next picture does not fit in a row at that height,
+    the row is closed with or without it, whichever brings the row height (scaled to the width) closer to the target """
+
+    rows, row, row_aspect = [], [], 0.0
+    for idx, aspect in enumerate(aspects):
+        if row and (row_aspect + aspect) * row_height > width:
+            shorter, taller = width / (row_aspect + aspect), width / row_aspect
+            if taller / row_height > row_height / shorter:
+                rows.append(row + [idx])
+                row, row_aspect = [], 0.0
+                continue
+            rows.append(row)
+            row, row_aspect = [], 0.0
+        row.append(idx)
+        row_aspect += aspect
+    if row:
+        rows.append(row)
+    return rows
+
+
+def row_heights(row_aspects, size, row_height, stretch_last):
+    """ height of each row scaled to the full width, scaled down together if they do not fit in the height.
+    Unless stretch_last, the last row is not stretched beyond the target height """
+
+    width, height = size
+    heights = [width / row_aspect for row_aspect in row_aspects]
+    if not stretch_last:
+        heights[-1] = min(heights[-1], row_height)
+    scale = min(height / sum(heights), 1)
+    return [height * scale for height in heights]
+
+
+def justified_rows(aspects, size):
+    """ boxes [x, y, width, height] of pictures of the given aspect ratios laid out in rows filling the width of size,
+    in picture order: each picture keeps its aspect ratio, so it fills its box exactly.
+    Up to EXHAUSTIVE_PICTURES pictures, all the splits in rows are tried. Otherwise rows are broken for target row heights
+    found by bisection (the largest one whose rows fit in the height) and for 1 to ROW_COUNTS rows, keeping the rows
+    covering the biggest area, with the last row stretched to the full width or not. Rows are centered vertically """
+
+    width, height = size
+    best_area, rows, heights = -1, None, None
+
+    # few pictures: the rows covering the biggest area, among all the ways to split the pictures in rows
+    if len(aspects) <= EXHAUSTIVE_PICTURES:
+        for breaks in range(2 ** (len(aspects) - 1)):
+            candidate_rows, row = [], [0]
+            for idx in range(1, len(aspects)):
+                if breaks & (1 << (idx - 1)):
+                    candidate_rows.append(row)
+                    row = []
+                row.append(idx)
+            candidate_rows.append(row)
+            row_aspects = [sum(aspects[idx] for idx in row) for row in candidate_rows]
+            candidate_heights = row_heights(row_aspects, size, height, True)
+            area = sum(row_aspect * candidate_height ** 2 for row_aspect, candidate_height in zip(row_aspects, candidate_heights))
+            if area > best_area:
+                best_area, rows, heights = area, candidate_rows, candidate_heights
+
+    # bisection steps, then the row heights of 1 to ROW_COUNTS rows
+    low, high = height / len(aspects) / 100, height
+    steps = SEARCH_STEPS + ROW_COUNTS if len(aspects) > EXHAUSTIVE_PICTURES else 0
+    for step in range(steps):
+        row_height = (low + high) / 2 if step < SEARCH_STEPS else height / (step - SEARCH_STEPS + 1)
+        candidate_rows = break_rows(aspects, width, row_height)
+        row_aspects = [sum(aspects[idx] for idx in row) for row in candidate_rows]
+
+        for stretch_last in (False, True):
+            candidate_heights = row_heights(row_aspects, size, row_height, stretch_last)
+            area = sum(row_aspect * candidate_height ** 2 for row_aspect, candidate_height in zip(row_aspects, candidate_heights))
+            if area > best_area:
+                best_area, rows, heights = area, candidate_rows, candidate_heights
+
+        if sum(width / row_aspect for row_aspect in row_aspects[:-1]) + min(width / row_aspects[-1], row_height) <= height:
+            low = row_height
+        else:
+            high = row_height
+
+    boxes = [None] * len(aspects)
+    y = (height - sum(heights)) / 2
+    for row, row_height in zip(rows, heights):
+        x = (width - sum(aspects[idx] for idx in row) * row_height) / 2
+        for idx in row:
+            boxes[idx] = [x, y, aspects[idx] * row_height, row_height]
+            x += aspects[idx] * row_height
+        y += row_height
+    return boxes
+
+
+def generated_template(aspects, size):
+    """ layout for pictures of the given aspect ratios on a collage of size, pictures above the description/logo strip """
+
+    width, height = size
+    strip = height * STRIP_HEIGHT
+    boxes = justified_rows(aspects, (width, height - strip))
+
+    # normalized, as fractions of the collage size
+    layout = {str(idx + 1): [x / width, y / height, w / width, h / height] for idx, (x, y, w, h) in enumerate(boxes)}
+    layout['Description'] = [0, 1 - STRIP_HEIGHT, 1 - LOGO_WIDTH, STRIP_HEIGHT, DESCRIPTION_FORMAT]
+    layout['Logo'] = [1 - LOGO_WIDTH, 1 - STRIP_HEIGHT, LOGO_WIDTH, STRIP_HEIGHT]
+    return GeneratedTemplate(layout, len(aspects))
+
+
+def assign_slots(picture_aspects, slot_aspects):
+    """ slot (index) of each picture, matching aspect ratios: the n-th widest picture goes to the n-th widest slot.
+    Sorting both sides minimizes the total log aspect ratio difference. Ties keep the picture and slot order """
+
+    pictures = sorted(range(len(picture_aspects)), key=lambda idx: picture_aspects[idx])
+    slots = sorted(range(len(slot_aspects)), key=lambda idx: slot_aspects[idx])
+    assignment = [0] * len(picture_aspects)
+    for picture, slot in zip(pictures, slots):
+        assignment[picture] = slot
+    return assignment
+
+
+def picture_aspects(paths):
+    """ upright aspect ratio of each picture, read from the headers (see metadata.py) """
+
+    infos = get_index().folder(paths)
+    return [infos[path].aspect if path in infos else DEFAULT_ASPECT for path in paths]
+
+
+def find_template(template_id, pic_nb, settings):
+    """ template file for a number of pictures (the requested one if it matches), None if there is none or for AUTO_TEMPLATE """
+
+    if template_id == AUTO_TEMPLATE:
+        return None
+    return get_registry(settings['TEMPLATE_DIR']).resolve(template_id, pic_nb)
+
+
+def plan_collage(paths, template_id, settings, keep_order=False):
+    """ template and slot number of each picture (1 based), as {path: slot} in slot order.
+    Pictures are laid out in generated rows when no template matches their number (or for AUTO_TEMPLATE),
+    and matched to the template slots by aspect ratio if SLOT_ASSIGNMENT is 'aspect'.
+    Pictures keep their order (n-th picture in n-th slot) when keep_order (specified pictures) or sorted by capture time """
+
+    template = find_template(template_id, len(paths), settings)
+    if not template:
+        return generated_template(picture_aspects(paths), (settings['COLLAGE_WIDTH'], settings['COLLAGE_HEIGHT'])), {path: idx + 1 for idx, path in enumerate(paths)}
+
+    if settings.get('SLOT_ASSIGNMENT', 'order') != 'aspect' or keep_order or settings.get('PICTURE_ORDER', 'name') == 'capture_time':
+        return template, {path: idx + 1 for idx, path in enumerate(paths)}
+
+    boxes = template.boxes((settings['COLLAGE_WIDTH'], settings['COLLAGE_HEIGHT']))
+    slot_aspects = [boxes[str(idx + 1)][2] / max(boxes[str(idx + 1)][3], 1) for idx in range(template.pic_nb)]
+    assignment = assign_slots(picture_aspects(paths), slot_aspects)
+    return template, {path: slot + 1 for slot, path in sorted(zip(assignment, paths))}
@@ -0,0 +1,85 @@
+from layout import find_template, AUTO_TEMPLATE
+from datetime import datetime
+import hashlib
+import json
+import os
+
+# manifests are stored in the export folder, one file per source folder
+MANIFEST_DIR = '_manifest'
+
+# settings changing the rendered picture
+RENDER_SETTINGS = ['COLLAGE_WIDTH', 'COLLAGE_HEIGHT', 'TEXT_FONT', 'TEXT_SIZE', 'TEMPLATE_DIR', 'COCO_LOGO', 'BKG_COLOR',
+                   'TEXT_COLOR', 'RESAMPLE_QUALITY', 'SLOT_MODE', 'OUTPUT_FORMAT', 'JPEG_QUALITY', 'WEBP_QUALITY', 'PNG_COMPRESS_LEVEL', 'OUTPUT_SIZES',
+                   'SLOT_ASSIGNMENT']
+
+
+def file_signature(path):
+    """ (path, size, mtime) of a file, None values if missing """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [os.path.abspath(path), None, None]
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def job_fingerprint(job, settings):
+    """ hash of everything a collage depends on: pictures, template, settings, description and options """
+
+    # generated layouts only depend on the pictures
+    template = find_template(job.template, len(job.pictures), settings)
+
+    inputs = {
+        'pictures': [file_signature(path) for path in job.pictures],
+        'template': template.layout if template else AUTO_TEMPLATE,
+        'settings': {key: settings.get(key) for key in RENDER_SETTINGS},
+        'files': [file_signature(settings['TEXT_FONT']), file_signature(settings['COCO_LOGO'])] + ([file_signature(job.framing)] if job.framing else []),
+        'description': [job.title, job.subtitle, job.time, job.notes],
+        'options': [job.desc, job.logo, job.quality, job.slot_mode, job.output_format, job.output_sizes, job.keep_order],
+    }
+
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def manifest_path(job):
+    """ path of the manifest of a job's source folder """
+
+    key = hashlib.sha1(os.path.abspath(job.folder).encode('utf-8')).hexdigest()
+    return os.path.join(job.export_dir, MANIFEST_DIR, f'{key}.json')
+
+
+def read_manifest(job):
+    """ manifest of the last render of a job's folder, None if never rendered """
+
+    try:
+        with open(manifest_path(job)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(job, fingerprint, output):
+    """ record the fingerprint of a rendered collage. Written to a temp file first, jobs may run in parallel """
+
+    path = manifest_path(job)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    data = {
+        'folder': os.path.abspath(job.folder),
+        'fingerprint': fingerprint,
+        'output': output,
+        'rendered': datetime.now().isoformat(timespec='seconds'),
+    }
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def is_unchanged(job, fingerprint):
+    """ previous output path if the folder was already rendered with the same inputs and the output still exists """
+
+    previous = read_manifest(job)
+    if previous and previous.get('fingerprint') == fingerprint and os.path.isfile(previous.get('output', '')):
+        return previous['output']
+    return ''
@@ -0,0 +1,121 @@
+from PIL import Image
+from datetime import datetime
+import os
+
+# EXIF tags: orientation and capture time (DateTimeOriginal in the Exif IFD, DateTime of the main IFD as fallback)
+ORIENTATION_TAG = 0x0112
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL_TAG = 0x9003
+DATETIME_TAG = 0x0132
+
+
+class PictureInfo():
+    """ Header metadata of a picture: upright size, EXIF orientation (1-8) and capture time
+    (timestamp of the EXIF date, file modification time if the picture has none) """
+
+    def __init__(self, path, size, orientation, captured):
+        self.path = path
+        self.size = size
+        self.orientation = orientation
+        self.captured = captured
+
+    def __repr__(self):
+        """ override print method """
+        return f"{os.path.basename(self.path)}  |  {self.size[0]}x{self.size[1]}  |  Orientation: {self.orientation}  |  {datetime.fromtimestamp(self.captured)}"
+
+    @property
+    def aspect(self):
+        return self.size[0] / self.size[1]
+
+
+def parse_exif_date(value):
+    """ timestamp of an EXIF date ('YYYY:MM:DD HH:MM:SS'), None if missing or invalid """
+
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
+
+def probe(path, img=None, mtime=None):
+    """ metadata of a picture read from its header only, the pixels are never decoded.
+    img is the picture already opened by the caller, if any """
+
+    opened = img is None
+    if opened:
+        img = Image.open(path)
+    try:
+        # PNG pictures load all their pixels in getexif() when the eXIf chunk comes after the image data:
+        # only the chunks read when opening are used, orientation 1 without them
+        exif = img.getexif() if img.format != 'PNG' or 'exif' in img.info else Image.Exif()
+        width, height = img.size
+    finally:
+        if opened:
+            img.close()
+
+    orientation = exif.get(ORIENTATION_TAG, 1)
+    if orientation not in range(1, 9):
+        orientation = 1
+    # rotated by 90 degrees when displayed
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+
+    captured = parse_exif_date(exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL_TAG) or exif.get(DATETIME_TAG, ''))
+    if captured is None:
+        captured = mtime if mtime is not None else os.path.getmtime(path)
+
+    return PictureInfo(path, (width, height), orientation, captured)
+
+
+class MetadataIndex():
+    """ Picture metadata cached per (path, mtime): a picture is probed again only when it changes """
+
+    def __init__(self):
+        self.entries = {}   # absolute path > (mtime_ns, PictureInfo)
+
+    def get(self, path, img=None):
+        """ metadata of a picture, raises OSError if it cannot be read. img is the picture if already opened """
+
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry and entry[0] == stat.st_mtime_ns:
+            return entry[1]
+
+        info = probe(path, img, stat.st_mtime)
+        self.entries[key] = stat.st_mtime_ns, info
+        return info
+
+    def folder(self, paths):
+        """ {path: metadata} of several pictures, unreadable ones left out """
+
+        infos = {}
+        for path in paths:
+            try:
+                infos[path] = self.get(path)
+            except OSError as e:
+                print(f"Could not read {path} > Ignored: {e}")
+        return infos
+
+
+# one index per process
+_index = None
+
+
+def get_index():
+    """ process-wide metadata index """
+
+    global _index
+    if _index is None:
+        _index = MetadataIndex()
+    return _index
+
+
+def order_pictures(paths, order='name'):
+    """ pictures sorted by capture time for 'capture_time' (unreadable ones last), unchanged otherwise """
+
+    if order != 'capture_time':
+        return paths
+
+    infos = get_index().folder(paths)
+    return sorted(paths, key=lambda path: (path not in infos, infos[path].captured if path in infos else 0, path))
@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import threading
+import time
+
+# timed stages of a collage render
+STAGES = ('template', 'decode', 'orient', 'resize', 'paste', 'text', 'encode', 'write')
+COUNTERS = ('pictures', 'cache_hits', 'bytes_read', 'pixels_decoded', 'bytes_written')
+
+
+class RenderMetrics():
+    """ Time spent in each stage and counters of one collage render """
+
+    def __init__(self):
+        self.times = dict.fromkeys(STAGES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @contextmanager
+    def stage(self, name):
+        """ add the time spent in the block to a stage """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def add(self, name, seconds):
+        self.times[name] += seconds
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def record(self, **fields):
+        """ JSON-serializable record of the render: fields (folder, output...) then stage times and counters """
+
+        return {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            **fields,
+            'stages': {stage: round(seconds, 6) for stage, seconds in self.times.items()},
+            'counters': dict(self.counters),
+        }
+
+
+class NoMetrics(RenderMetrics):
+    """ Metrics of code running outside of a collage render (e.g. the Edit window), nothing is recorded """
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+_no_metrics = NoMetrics()
+# metrics of the collage rendered by the current thread, each pipeline stage thread renders one collage at a time
+_local = threading.local()
+
+
+def current_metrics():
+    """ metrics of the collage being rendered by this thread, a no-op recorder if none """
+    return getattr(_local, 'metrics', None) or _no_metrics
+
+
+@contextmanager
+def recording(metrics):
+    """ record the stages run by this thread in the block (e.g. picture loading) in metrics """
+
+    previous = getattr(_local, 'metrics', None)
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+def write_record(path, record):
+    """ append a record to a JSON-lines file. One write per line: processes can append to the same file """
+
+    if not path:
+        return
+    line = json.dumps(record, sort_keys=False) + '\n'
+    try:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Could not write metrics to {path}: {e}")
+
+
+def format_totals(records):
+    """ one line summary of the stage times and counters of several collage records """
+
+    times = dict.fromkeys(STAGES, 0.0)
+    counters = dict.fromkeys(COUNTERS, 0)
+    for record in records:
+        for stage in STAGES:
+            times[stage] += record['stages'].get(stage, 0.0)
+        for counter in COUNTERS:
+            counters[counter] += record['counters'].get(counter, 0)
+
+    stages = ' | '.join(f"{stage} {seconds:.2f}s" for stage, seconds in times.items())
+    return (f"Stages: {stages} | {counters['pictures']} pictures ({counters['cache_hits']} cached), "
+            f"{counters['bytes_read'] / 1024 / 1024:.1f} MB read, {counters['pixels_decoded'] / 1000000:.1f} MP decoded, "
+            f"{counters['bytes_written'] / 1024 / 1024:.1f} MB written")
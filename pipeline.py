@@ -0,0 +1,371 @@
+from core import Collage
+from batch import BatchResult
+from manifest import job_fingerprint, is_unchanged, write_manifest
+from resources import get_settings
+from encoders import encode_picture
+from settings import load_settings
+from metrics import RenderMetrics, recording, write_record, format_totals
+from profiling import profile_job, write_report
+from scheduler import Scheduler
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+# stages of a collage render, each one runs in its own thread in a RenderPipeline
+STAGES = ('decode', 'compose', 'encode', 'write')
+
+
+class RenderTask():
+    """ One job going through the render stages. A stage failing (or a skipped folder) sets the result,
+    the following stages are then passed through without doing anything """
+
+    def __init__(self, job):
+        self.job = job
+        self.start = time.perf_counter()
+        self.result = None
+        self.collage = None
+        self.metrics = RenderMetrics()
+
+    def decode(self):
+        """ pick the template and open the pictures, unless the folder did not change since its last render """
+
+        job = self.job
+        self.fingerprint = job_fingerprint(job, get_settings())
+        previous_output = is_unchanged(job, self.fingerprint) if job.skip_unchanged else ''
+        if previous_output:
+            self.result = BatchResult(job.folder, save_path=previous_output, duration=time.perf_counter() - self.start, skipped=True)
+            return
+
+        self.collage = Collage(root='', title=job.title, subtitle=job.subtitle, Time=job.time, notes=job.notes, path=job.folder, pic_list=job.pictures, keep_order=job.keep_order)
+        self.collage.metrics = self.metrics
+        self.pic_dic = self.collage.generate_template(job.template)
+        # never open or copy to clipboard from a worker, the caller decides what to do with the result
+        self.collage.set_options(dir=job.export_dir, name=job.picture_name, desc=job.desc, logo=job.logo, clipboard=False,
+                                 quality=job.quality, slot_mode=job.slot_mode, output_format=job.output_format,
+                                 output_sizes=job.output_sizes, framing=job.framing)
+        # decoded once for the biggest output size rendered on a full canvas
+        canvas_sizes = [size for size in self.collage.output_sizes if not self.collage.banded(size)]
+        pic_dic = self.collage.scale_pic_dic(self.pic_dic, self.collage.largest_size(canvas_sizes)) if canvas_sizes else {}
+        self.images = self.collage.decode_pictures(pic_dic)
+
+    def compose(self):
+        self.canvases = [(size, self.collage.compose(self.pic_dic, self.images, size)) for size in self.collage.output_sizes
+                         if not self.collage.banded(size)]
+        self.images = None
+
+    def encode(self):
+        self.encoded = [(size, *encode_picture(canvas, self.collage.output_format, get_settings())) for size, canvas in self.canvases]
+        self.canvases = None
+
+    def write(self):
+        # poster sizes are composed, encoded and written band by band here
+        encoded = {size: (data, encode_time) for size, data, encode_time in self.encoded}
+        save_paths = [self.collage.write(*encoded[size], False, size) if size in encoded else self.collage.write_bands(self.pic_dic, size, False)
+                      for size in self.collage.output_sizes]
+        self.encoded = None
+        write_manifest(self.job, self.fingerprint, save_paths[0])
+        self.result = BatchResult(self.job.folder, save_path=save_paths[0], duration=time.perf_counter() - self.start)
+
+    def run(self, stage):
+        """ run a stage, returns False if it was passed through """
+
+        if self.result is not None:
+            return False
+        try:
+            # times of the loaders called by the stage are recorded too
+            with recording(self.metrics):
+                getattr(self, stage)()
+        except Exception as e:
+            self.result = BatchResult(self.job.folder, error=f"{type(e).__name__}: {e}", duration=time.perf_counter() - self.start)
+        if self.result is not None:
+            self.result.metrics = self.record()
+        return True
+
+    def record(self):
+        """ metrics record of the job, also for skipped and failed ones """
+
+        result = self.result
+        fields = dict(skipped=result.skipped, error=result.error)
+        if self.collage:
+            return self.collage.metrics_record(result.save_path, result.duration, **fields)
+        return self.metrics.record(folder=self.job.folder, template=self.job.template, output=result.save_path,
+                                   duration=round(result.duration, 6), **fields)
+
+
+def render_job(job, stats=None):
+    """ render a single job, all stages one after another, adding the stage times to stats if given.
+    Module level so it can be pickled by a pool """
+
+    task = RenderTask(job)
+    for stage in STAGES:
+        start = time.perf_counter()
+        if task.run(stage) and stats is not None:
+            stats[stage][0] += 1
+            stats[stage][1] += time.perf_counter() - start
+    return task.result
+
+
+def empty_stats():
+    """ {stage: [collages processed, busy time in seconds]} """
+    return {stage: [0, 0.0] for stage in STAGES}
+
+
+def format_stats(stats, duration):
+    """ one line throughput report, per stage (collages per second of busy stage time) and overall """
+
+    stages = []
+    for stage in STAGES:
+        count, busy = stats[stage]
+        stages.append(f"{stage} {count / busy:.1f}/s" if busy else f"{stage} -")
+    rendered = stats[STAGES[-1]][0]
+    return f"Pipeline: {' | '.join(stages)} | total {rendered / duration if duration else 0:.1f} collages/s over {duration:.2f}s"
+
+
+class RenderPipeline():
+    """ Renders jobs through decode > compose > encode > write threads connected by bounded queues, so that
+    collage N is encoded and written while collage N+1 is decoded and composed (Pillow releases the GIL while
+    decoding, resizing and encoding). on_done(key, result) is called from the write thread """
+
+    def __init__(self, depth=2, on_done=None):
+        self.on_done = on_done
+        # at most `depth` collages wait between two stages, so memory stays bounded
+        self.queues = [queue.Queue(maxsize=max(depth, 1)) for stage in STAGES]
+        self.stats = empty_stats()
+        self.threads = [threading.Thread(target=self.run_stage, args=(idx,), daemon=True) for idx in range(len(STAGES))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, job):
+        """ queue a job, blocks while the decode stage is busy and its queue is full """
+        self.queues[0].put((key, job))
+
+    def run_stage(self, idx):
+        """ stage thread: process tasks until the end of the stream (None) """
+
+        stage = STAGES[idx]
+        next_queue = self.queues[idx + 1] if idx + 1 < len(STAGES) else None
+
+        while True:
+            item = self.queues[idx].get()
+            if item is None:
+                if next_queue:
+                    next_queue.put(None)
+                return
+
+            key, task = item
+            if idx == 0:
+                task = RenderTask(task)
+
+            start = time.perf_counter()
+            if task.run(stage):
+                self.stats[stage][0] += 1
+                self.stats[stage][1] += time.perf_counter() - start
+
+            if next_queue:
+                next_queue.put((key, task))
+            elif self.on_done:
+                self.on_done(key, task.result)
+
+    def close(self):
+        """ finish the queued jobs and stop the threads """
+
+        self.queues[0].put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def pipeline_worker(job_queue, event_queue, depth, profile_dir=''):
+    """ worker process: render jobs from the shared queue through a local pipeline until it gets None.
+    Profiled jobs are rendered one after another on this thread instead: cProfile only sees the thread it runs on,
+    and each profile only contains its own job """
+
+    pid = os.getpid()
+    if profile_dir:
+        stats = empty_stats()
+        for key, job in iter(job_queue.get, None):
+            event_queue.put(('start', key, pid))
+            event_queue.put(('done', key, profile_job(job, profile_dir, render_job, stats)))
+        event_queue.put(('stats', pid, stats))
+        return
+
+    pipeline = RenderPipeline(depth, on_done=lambda key, result: event_queue.put(('done', key, result)))
+
+    for key, job in iter(job_queue.get, None):
+        event_queue.put(('start', key, pid))
+        pipeline.submit(key, job)
+
+    pipeline.close()
+    event_queue.put(('stats', pid, pipeline.stats))
+
+
+class PipelinePool():
+    """ RenderPipelines running in a pool of processes. Jobs are pulled from a shared queue, so a process takes
+    a new job as soon as its decode stage is free. Same interface as RenderPipeline, on_done(key, result) is called
+    from a reader thread. A crashed process fails the jobs it was rendering and is replaced.
+    Jobs are profiled in profile_dir if set (see profiling.py) """
+
+    def __init__(self, processes, depth=2, on_done=None, profile_dir=''):
+        self.depth = depth
+        self.profile_dir = profile_dir
+        self.on_done = on_done
+        self.job_queue = multiprocessing.Queue()
+        self.event_queue = multiprocessing.Queue()
+        self.jobs = {}       # key > job not done yet
+        self.started = {}    # key > pid of the process rendering it
+        self.stats = empty_stats()
+        self.crashed = set()  # pids of the crashed processes already handled
+        self.closing = False
+        self.lock = threading.Lock()
+        self.workers = [self.start_worker() for _ in range(max(processes, 1))]
+        self.reader = threading.Thread(target=self.read_events, daemon=True)
+        self.reader.start()
+
+    def start_worker(self):
+        worker = multiprocessing.Process(target=pipeline_worker, args=(self.job_queue, self.event_queue, self.depth, self.profile_dir), daemon=True)
+        worker.start()
+        return worker
+
+    def submit(self, key, job):
+        """ queue a job, never blocks """
+
+        with self.lock:
+            self.jobs[key] = job
+        self.job_queue.put((key, job))
+
+    def finish(self, key, result):
+        with self.lock:
+            self.started.pop(key, None)
+            if self.jobs.pop(key, None) is None:
+                return
+        if self.on_done:
+            self.on_done(key, result)
+
+    def check_workers(self):
+        """ fail the jobs of crashed processes (killed, out of memory...) and replace them """
+
+        for idx, worker in enumerate(self.workers):
+            if worker.is_alive() or worker.exitcode == 0 or worker.pid in self.crashed:
+                continue
+            self.crashed.add(worker.pid)
+            with self.lock:
+                crashed = [key for key, pid in self.started.items() if pid == worker.pid]
+            for key in crashed:
+                self.finish(key, BatchResult(self.jobs[key].folder, error=f"worker process stopped (exit code {worker.exitcode})"))
+            # once closing, a replacement could wait forever for an end of stream already consumed
+            if not self.closing:
+                self.workers[idx] = self.start_worker()
+
+    def read_events(self):
+        """ reader thread: forward results and collect stats until all processes are done """
+
+        while True:
+            try:
+                event, key, value = self.event_queue.get(timeout=0.5)
+            except queue.Empty:
+                self.check_workers()
+                if self.closing and not any(worker.is_alive() for worker in self.workers):
+                    break
+                continue
+
+            if event == 'start':
+                with self.lock:
+                    self.started[key] = value
+            elif event == 'done':
+                self.finish(key, value)
+            elif event == 'stats':
+                for stage in STAGES:
+                    self.stats[stage][0] += value[stage][0]
+                    self.stats[stage][1] += value[stage][1]
+
+        # all processes stopped before rendering some jobs
+        for key in list(self.jobs):
+            self.finish(key, BatchResult(self.jobs[key].folder, error="worker processes stopped"))
+
+    def close(self):
+        """ finish the queued jobs and stop the processes """
+
+        self.closing = True
+        for worker in self.workers:
+            self.job_queue.put(None)
+        self.reader.join()
+        for worker in self.workers:
+            worker.join()
+
+
+class BatchRenderer():
+    """ Streams batch jobs through render pipelines, in one or more processes, and collects their results.
+    Jobs are started largest first and while their estimated memory fits in MEMORY_BUDGET_MB (see scheduler.py).
+    With a profile_dir, each job is profiled and a report of the run is written there (see profiling.py) """
+
+    def __init__(self, processes=0, depth=0, metrics_file=None, profile_dir=None, profile_top=0):
+        settings = self.settings = load_settings()
+        # 0 or missing means one process per core
+        self.processes = processes or settings.get('BATCH_PROCESSES', 0) or os.cpu_count() or 1
+        self.depth = depth or settings.get('PIPELINE_DEPTH', 2)
+        # records are written here, by the calling process only
+        self.metrics_file = settings.get('METRICS_FILE', '') if metrics_file is None else metrics_file
+        self.profile_dir = settings.get('PROFILE_DIR', '') if profile_dir is None else profile_dir
+        self.profile_top = profile_top or settings.get('PROFILE_TOP', 20)
+
+    def run(self, jobs, progress=None):
+        """ render all jobs, calling progress(done, total, result, eta) after each one, eta being the estimated
+        seconds left. Returns results in job order """
+
+        results = [None] * len(jobs)
+        workers = min(self.processes, len(jobs))
+        start = time.perf_counter()
+
+        # costs are estimated from the picture headers before starting
+        scheduler = Scheduler(jobs, self.settings, workers)
+        if len(jobs) > 1:
+            print(scheduler.summary())
+
+        # nothing to overlap for a single job, profiled jobs of a single process run one after another
+        if len(jobs) <= 1 or (self.profile_dir and workers <= 1):
+            stats = empty_stats()
+            for done, idx in enumerate(scheduler.order, 1):
+                job = jobs[idx]
+                results[idx] = profile_job(job, self.profile_dir, render_job, stats) if self.profile_dir else render_job(job, stats)
+                scheduler.release(idx)
+                write_record(self.metrics_file, results[idx].metrics)
+                if progress:
+                    progress(done, len(jobs), results[idx], scheduler.eta())
+
+        else:
+            # results are reported on the calling thread, in completion order
+            done_queue = queue.Queue()
+            on_done = lambda idx, result: done_queue.put((idx, result))
+            pipeline = RenderPipeline(self.depth, on_done) if workers <= 1 else PipelinePool(workers, self.depth, on_done, self.profile_dir)
+
+            # waits for memory and submit blocks while the in-process pipeline is full, feed it from another thread
+            def feed():
+                for idx in scheduler.order:
+                    scheduler.admit(idx)
+                    pipeline.submit(idx, jobs[idx])
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+
+            for done in range(1, len(jobs) + 1):
+                idx, result = done_queue.get()
+                scheduler.release(idx)
+                results[idx] = result
+                write_record(self.metrics_file, result.metrics)
+                if progress:
+                    progress(done, len(jobs), result, scheduler.eta())
+
+            feeder.join()
+            pipeline.close()
+            stats = pipeline.stats
+
+        if len(jobs) > 1:
+            print(format_stats(stats, time.perf_counter() - start))
+            print(format_totals([result.metrics for result in results if result.metrics]))
+        if self.profile_dir:
+            report_path = write_report(self.profile_dir, [result.profile for result in results], self.profile_top)
+            if report_path:
+                print(f"Profile report saved at {report_path}")
+
+        return results
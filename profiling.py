@@ -0,0 +1,128 @@
+from encoders import format_size
+from datetime import datetime
+import cProfile
+import hashlib
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+# allocation sites kept per job, and frames recorded per allocation (more frames are slower)
+ALLOCATION_SITES = 10
+TRACE_FRAMES = 1
+
+
+def profile_name(folder):
+    """ file name of the profile of a folder: folder name and a hash of its path (folders of different roots can share a name) """
+    return f"{os.path.basename(os.path.normpath(folder))}_{hashlib.md5(folder.encode('utf-8')).hexdigest()[:8]}"
+
+
+def profile_job(job, profile_dir, render, *args):
+    """ run render(job, *args) under cProfile and tracemalloc, returns its result with the profile summary attached.
+    The function profile (wall clock times) is saved as PROFILE_DIR/<folder>_<hash>.prof (readable with pstats, snakeviz...).
+    cProfile only records the calling thread: render must run all the stages of the job on it, like pipeline.render_job,
+    not through the stage threads of a RenderPipeline. tracemalloc sees every thread of the process and the CPU time
+    counts them all: jobs must be rendered one at a time to be profiled apart """
+
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_path = os.path.join(profile_dir, profile_name(job.folder) + '.prof')
+
+    tracemalloc.start(TRACE_FRAMES)
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    # cProfile times are wall clock, CPU time of the process (all threads) is measured apart
+    cpu_start = time.process_time()
+    profiler.enable()
+    try:
+        result = render(job, *args)
+    finally:
+        profiler.disable()
+        duration = time.perf_counter() - start
+        cpu_time = time.process_time() - cpu_start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    profiler.dump_stats(profile_path)
+    # pixel buffers are allocated by Pillow outside of the Python allocator, tracemalloc only sees Python objects
+    allocations = [{'site': str(stat.traceback[0]), 'size': stat.size, 'count': stat.count}
+                   for stat in snapshot.statistics('lineno')[:ALLOCATION_SITES]]
+
+    metrics = result.metrics or {}
+    result.profile = {
+        'folder': job.folder,
+        'template': metrics.get('template') or job.template,
+        'pictures': len(job.pictures),
+        'types': '+'.join(sorted({os.path.splitext(picture)[1].lower().lstrip('.') for picture in job.pictures})),
+        'pixels_decoded': metrics.get('counters', {}).get('pixels_decoded', 0),
+        'duration': round(duration, 6),
+        'cpu_time': round(cpu_time, 6),
+        'python_peak': peak,
+        'allocations': allocations,
+        'skipped': result.skipped,
+        'error': result.error,
+        'profile': profile_path,
+    }
+    return result
+
+
+def group_profiles(profiles, key):
+    """ [(group, collages, mean duration, max duration)] of the profiles grouped by one of their fields, slowest first """
+
+    groups = {}
+    for profile in profiles:
+        groups.setdefault(profile[key], []).append(profile['duration'])
+    rows = [(group, len(durations), sum(durations) / len(durations), max(durations)) for group, durations in groups.items()]
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def write_report(profile_dir, profiles, top=20):
+    """ aggregate the profiles of a run: PROFILE_DIR/report.txt (slowest folders, mean time per template and picture type,
+    biggest allocation sites, slowest functions of all jobs), report.json (all profile summaries) and all.prof
+    (function profile of all jobs). Returns the path of the text report, '' if there is nothing to report """
+
+    profiles = [profile for profile in profiles if profile and not profile['skipped']]
+    if not profiles:
+        return ''
+    os.makedirs(profile_dir, exist_ok=True)
+    lines = [f"Profile of {len(profiles)} collage(s), {datetime.now().isoformat(timespec='seconds')}", '']
+
+    lines.append(f"Slowest folders (top {top}):")
+    for profile in sorted(profiles, key=lambda profile: profile['duration'], reverse=True)[:top]:
+        status = f"  ERROR: {profile['error']}" if profile['error'] else ''
+        lines.append(f"  {profile['duration']:8.2f}s  cpu {profile['cpu_time']:7.2f}s  python peak {format_size(profile['python_peak']):>9}  "
+                     f"{profile['template']:10} {profile['pictures']:4} x {profile['types']:8} {profile['pixels_decoded'] / 1000000:8.1f} MP  "
+                     f"{profile['folder']}  ({os.path.basename(profile['profile'])}){status}")
+
+    for title, key in (('template', 'template'), ('picture type', 'types')):
+        lines += ['', f"Mean time per {title}:"]
+        for group, count, mean, longest in group_profiles(profiles, key):
+            lines.append(f"  {group:12} {count:5} collage(s)  mean {mean:7.2f}s  max {longest:7.2f}s")
+
+    # allocation sites of all jobs, from the biggest sites of each job
+    sites = {}
+    for profile in profiles:
+        for allocation in profile['allocations']:
+            size, count = sites.get(allocation['site'], (0, 0))
+            sites[allocation['site']] = size + allocation['size'], count + allocation['count']
+    lines += ['', f"Biggest Python allocation sites still alive at the end of the jobs (top {top}, Pillow pixel buffers not included):"]
+    for site, (size, count) in sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+        lines.append(f"  {format_size(size):>9}  {count:8} blocks  {site}")
+
+    # profiles of the jobs that could not be read (removed meanwhile) are left out
+    paths = [profile['profile'] for profile in profiles if os.path.isfile(profile['profile'])]
+    if paths:
+        stream = io.StringIO()
+        stats = pstats.Stats(*paths, stream=stream)
+        stats.dump_stats(os.path.join(profile_dir, 'all.prof'))
+        stats.sort_stats('cumulative').print_stats(top)
+        lines += ['', f"Slowest functions of all jobs (top {top} by cumulative time, see all.prof):", stream.getvalue()]
+
+    with open(os.path.join(profile_dir, 'report.json'), 'w') as f:
+        json.dump(profiles, f, indent=4)
+    report_path = os.path.join(profile_dir, 'report.txt')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+    return report_path
@@ -0,0 +1,59 @@
+from settings import load_settings, SETTINGS_PATH
+from imaging import load_picture
+from PIL import ImageFont
+import os
+
+# process-wide caches, an entry is reloaded when the modification time of its file changes
+_settings = {}
+_fonts = {}
+_logos = {}
+
+
+def get_mtime(path):
+    """ modification time of a file, None if missing """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_settings():
+    """ parsed settings, read again only when settings.json changes. Do not modify the returned dict """
+
+    mtime = get_mtime(SETTINGS_PATH)
+    cached = _settings.get(SETTINGS_PATH)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    settings = load_settings()
+    if settings is not None:
+        _settings[SETTINGS_PATH] = mtime, settings
+    return settings
+
+
+def get_font(path, size):
+    """ truetype font loaded once per (path, size) """
+
+    key = path, size
+    mtime = get_mtime(path)
+    cached = _fonts.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    font = ImageFont.truetype(path, size)
+    _fonts[key] = mtime, font
+    return font
+
+
+def get_logo(path, box, quality='high'):
+    """ logo resized to fit inside box and converted to RGBA, loaded once per target box. Do not modify the returned image """
+
+    key = path, tuple(box), quality
+    mtime = get_mtime(path)
+    cached = _logos.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    logo = load_picture(path, box, quality)
+    _logos[key] = mtime, logo
+    return logo
@@ -0,0 +1,197 @@
+from metadata import get_index
+from layout import plan_collage
+from template_registry import scale_box
+from encoders import get_output_format, canvas_mode
+import os
+import threading
+import time
+
+# rough throughput of a single process, only used until the first jobs of a batch are done (see Scheduler.eta)
+DECODE_SPEED = 60e6     # decoded pixels per second
+ENCODE_SPEED = {'png': 3e6, 'jpeg': 40e6, 'webp': 6e6}  # output pixels per second
+
+# bytes per pixel: decoded pictures (RGB, or RGBA with alpha, counted as RGBA) and pictures resized to their slot (RGBA).
+# Canvases are RGB, RGBA only with a transparent background (see encoders.canvas_mode)
+DECODED_BYTES = 4
+SLOT_BYTES = 4
+
+# JPEG pictures are decoded reduced by up to 8 (see imaging.load_picture)
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+MAX_DRAFT_SCALE = 8
+
+
+class JobCost():
+    """ Estimated cost of a job, from the picture headers: pixels decoded, bytes read, peak memory (bytes) and seconds """
+
+    def __init__(self, pixels=0, read=0, memory=0, seconds=0.0):
+        self.pixels = pixels
+        self.read = read
+        self.memory = memory
+        self.seconds = seconds
+
+    def __repr__(self):
+        """ override print method """
+        return f"{self.pixels / 1000000:.1f} MP, {self.read / 1024 / 1024:.1f} MB read, {self.memory / 1024 / 1024:.0f} MB peak, {self.seconds:.2f}s"
+
+
+def decoded_size(path, size, box):
+    """ size a picture is decoded at for a slot: JPEG pictures are reduced by a power of two as long as they still cover the slot """
+
+    if not path.lower().endswith(JPEG_EXTENSIONS) or not box:
+        return size
+    scale = 1
+    while scale < MAX_DRAFT_SCALE and size[0] // (scale * 2) >= box[0] and size[1] // (scale * 2) >= box[1]:
+        scale *= 2
+    return -(-size[0] // scale), -(-size[1] // scale)
+
+
+def output_boxes(template, size, settings):
+    """ template boxes in pixels for an output size, scaled from the collage size like core.Collage.scale_pic_dic """
+
+    collage_size = settings['COLLAGE_WIDTH'], settings['COLLAGE_HEIGHT']
+    scale_x, scale_y = size[0] / collage_size[0], size[1] / collage_size[1]
+    return {key: scale_box(box, scale_x, scale_y) for key, box in template.boxes(collage_size).items()}
+
+
+def band_memory(boxes, slots, size, band_height, canvas_bytes):
+    """ peak memory of a poster written band by band (see core.Collage.write_bands): one band of the canvas, and the
+    sources overlapping it, each decoded from its first band to its last one, with its rows of the band resampled """
+
+    width, height = size
+    bands = -(-height // band_height)
+    # memory added at the first band of each source and freed after its last one
+    changes = [0] * (bands + 1)
+    for path, slot in slots.items():
+        try:
+            info = get_index().get(path)
+        except OSError:
+            continue
+        y, box_w, box_h = boxes[str(slot)][1:4]
+        if box_h <= 0:
+            continue
+        decoded_w, decoded_h = decoded_size(path, info.size, (box_w, box_h))
+        memory = DECODED_BYTES * decoded_w * decoded_h + SLOT_BYTES * box_w * min(band_height, box_h)
+        first, last = min(int(y) // band_height, bands - 1), min(int(y + box_h - 1) // band_height, bands - 1)
+        changes[first] += memory
+        changes[last + 1] -= memory
+
+    peak, sources = 0, 0
+    for change in changes[:bands]:
+        sources += change
+        peak = max(peak, sources)
+    return canvas_bytes * width * band_height + peak
+
+
+def estimate_job(job, settings):
+    """ cost of a job read from the picture headers only (see metadata.py), nothing is decoded.
+    Unreadable pictures count for nothing, the render reports them """
+
+    output_format = get_output_format(settings, job.output_format)
+    output_sizes = [tuple(size) for size in job.output_sizes or settings.get('OUTPUT_SIZES') or [(settings['COLLAGE_WIDTH'], settings['COLLAGE_HEIGHT'])]]
+    banded = lambda size: output_format == 'png' and size[0] * size[1] > settings.get('BAND_THRESHOLD_MP', 40) * 1000000
+    canvas_sizes = [size for size in output_sizes if not banded(size)]
+    largest = max(canvas_sizes or output_sizes, key=lambda size: size[0] * size[1])
+    canvas_bytes = len(canvas_mode(output_format, settings['BKG_COLOR']))
+
+    # slot sizes of the template (or generated layout) for the biggest canvas
+    template, slots = plan_collage([os.path.join(job.folder, picture) for picture in job.pictures], job.template, settings, job.keep_order)
+    boxes = output_boxes(template, largest, settings)
+
+    cost = JobCost()
+    largest_decode = 0
+    slots_area = 0
+    for path, slot in slots.items():
+        try:
+            info = get_index().get(path)
+            cost.read += os.path.getsize(path)
+        except OSError:
+            continue
+        box = boxes[str(slot)][2:4]
+        width, height = decoded_size(path, info.size, box)
+        cost.pixels += width * height
+        largest_decode = max(largest_decode, width * height)
+        slots_area += box[0] * box[1]
+
+    # pictures are decoded one at a time and kept resized to their slot until composed, the canvases of all sizes are then encoded
+    canvas_area = sum(size[0] * size[1] for size in canvas_sizes)
+    canvas_memory = DECODED_BYTES * largest_decode + SLOT_BYTES * slots_area + canvas_bytes * canvas_area if canvas_sizes else 0
+    # posters only keep the sources of the current band decoded
+    band_height = settings.get('BAND_HEIGHT', 256)
+    poster_memory = max((band_memory(output_boxes(template, size, settings), slots, size, band_height, canvas_bytes) for size in output_sizes if banded(size)), default=0)
+
+    cost.memory = max(canvas_memory, poster_memory)
+    cost.seconds = cost.pixels / DECODE_SPEED + sum(size[0] * size[1] for size in output_sizes) / ENCODE_SPEED[output_format]
+    return cost
+
+
+def memory_budget(settings):
+    """ memory available to the jobs rendered at the same time in bytes: MEMORY_BUDGET_MB, half of the physical memory if 0.
+    None (no limit) if the physical memory cannot be read """
+
+    budget_mb = settings.get('MEMORY_BUDGET_MB', 0)
+    if budget_mb:
+        return budget_mb * 1024 * 1024
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+
+class Scheduler():
+    """ Orders batch jobs by estimated cost, largest first so that small jobs fill the gaps at the end of the batch,
+    admits them while their estimated memory fits in the budget and estimates the remaining time.
+    A job bigger than the whole budget is admitted alone """
+
+    def __init__(self, jobs, settings, workers=1):
+        self.folders = [job.folder for job in jobs]
+        self.costs = [estimate_job(job, settings) for job in jobs]
+        self.order = sorted(range(len(jobs)), key=lambda idx: self.costs[idx].seconds, reverse=True)
+        self.budget = memory_budget(settings)
+        self.workers = workers
+        self.reserved = {}      # job index > memory reserved while it renders
+        self.remaining = set(range(len(jobs)))
+        self.started = time.perf_counter()
+        self.condition = threading.Condition()
+
+    def summary(self):
+        """ one line estimate of the batch """
+
+        pixels = sum(cost.pixels for cost in self.costs)
+        peak = max((cost.memory for cost in self.costs), default=0)
+        budget = f"{self.budget / 1024 / 1024:.0f} MB" if self.budget else 'no limit'
+        return (f"Scheduled {len(self.costs)} collage(s) largest first: {pixels / 1000000:.0f} MP to decode, "
+                f"biggest job {peak / 1024 / 1024:.0f} MB, memory budget {budget}, estimated {format_duration(self.eta())}")
+
+    def admit(self, idx):
+        """ wait until the memory of a job fits in the budget, then reserve it """
+
+        memory = self.costs[idx].memory
+        with self.condition:
+            if self.budget and memory > self.budget:
+                print(f"{self.folders[idx]} needs about {memory / 1024 / 1024:.0f} MB, more than the memory budget > Rendered alone.")
+            self.condition.wait_for(lambda: not self.reserved or not self.budget or sum(self.reserved.values()) + memory <= self.budget)
+            self.reserved[idx] = memory
+
+    def release(self, idx):
+        """ free the memory of a finished job """
+
+        with self.condition:
+            self.reserved.pop(idx, None)
+            self.remaining.discard(idx)
+            self.condition.notify_all()
+
+    def eta(self):
+        """ estimated seconds left: the estimates of the remaining jobs scaled by the throughput measured so far """
+
+        with self.condition:
+            remaining = sum(self.costs[idx].seconds for idx in self.remaining)
+            done = sum(cost.seconds for idx, cost in enumerate(self.costs) if idx not in self.remaining)
+        if not done:
+            return remaining / self.workers
+        return remaining * (time.perf_counter() - self.started) / done
@@ -0,0 +1,19 @@
+import json  # json file management
+import sys  # for exception handling
+
+# local path
+SETTINGS_PATH = 'settings.json'
+
+
+def load_settings():
+    """ load current settings """
+    try:
+        # load settings
+        with open(SETTINGS_PATH) as f:
+            data = json.load(f)
+    except:
+        print("Error loading the settings", sys.exc_info()[0])
+    else:
+        return data
+
+SETTINGS = load_settings()
@@ -0,0 +1,176 @@
+import json
+import os
+import re
+import time
+
+# T_[Number of pictures]_[template identifier].json
+TEMPLATE_NAME = re.compile(r'^T_(\d+)_(\d+)\.json$', re.IGNORECASE)
+
+
+def scale_box(box, scale_x, scale_y):
+    """ [x, y, width, height, ...] scaled and rounded to pixels. Edges are rounded, not sizes, so adjacent boxes stay adjacent """
+
+    x, y, width, height = box[:4]
+    left, top = round(x * scale_x), round(y * scale_y)
+    return [left, top, round((x + width) * scale_x) - left, round((y + height) * scale_y) - top, *box[4:]]
+
+
+class Template():
+    """ Template parsed and validated from its json file.
+    Boxes are either pixels (of a collage of the template "Size", COLLAGE_WIDTH x COLLAGE_HEIGHT if not given)
+    or normalized, as fractions of the collage size (all values between 0 and 1) """
+
+    def __init__(self, template_id, path, mtime, layout):
+        self.template_id = template_id
+        self.path = path
+        self.mtime = mtime
+        self.layout = layout
+        self.pic_nb, self.variant = [int(value) for value in TEMPLATE_NAME.match(os.path.basename(path)).groups()]
+
+    def __repr__(self):
+        """ override print method """
+        return f"{self.template_id}.json  |  Images: {self.pic_nb}  |  Template: {self.variant}"
+
+    @property
+    def keys(self):
+        """ picture numbers in picture order, then Description and Logo if defined """
+        return [str(idx + 1) for idx in range(self.pic_nb)] + [key for key in ('Description', 'Logo') if key in self.layout]
+
+    @property
+    def normalized(self):
+        return all(value <= 1 for key in self.keys for value in self.layout[key][:4])
+
+    def boxes(self, size):
+        """ {key: [x, y, w, h(, format)]} in pixels for a collage of size (width, height) """
+
+        width, height = size
+        reference_width, reference_height = (1, 1) if self.normalized else self.layout.get('Size', size)
+        return {key: scale_box(self.layout[key], width / reference_width, height / reference_height) for key in self.keys}
+
+
+def validate_layout(layout, pic_nb):
+    """ raise ValueError if a template layout does not match the template format """
+
+    def is_box(value):
+        return isinstance(value, list) and len(value) >= 4 and all(isinstance(v, (int, float)) and v >= 0 for v in value[:4])
+
+    if not isinstance(layout, dict):
+        raise ValueError("template should be a json object")
+
+    for idx in range(1, pic_nb + 1):
+        if not is_box(layout.get(str(idx))):
+            raise ValueError(f"picture {idx} should be defined as [x, y, width, height]")
+
+    extra_pictures = [key for key in layout if key.isdigit() and not 1 <= int(key) <= pic_nb]
+    if extra_pictures:
+        raise ValueError(f"pictures {', '.join(extra_pictures)} do not match the number of pictures in the template name")
+
+    if 'Description' in layout and not (is_box(layout['Description']) and len(layout['Description']) == 5 and isinstance(layout['Description'][4], str)):
+        raise ValueError("Description should be defined as [x, y, width, height, format]")
+
+    if 'Logo' in layout and not is_box(layout['Logo']):
+        raise ValueError("Logo should be defined as [x, y, width, height]")
+
+    if 'Size' in layout and not (isinstance(layout['Size'], list) and len(layout['Size']) == 2 and all(isinstance(v, (int, float)) and v > 0 for v in layout['Size'])):
+        raise ValueError("Size should be defined as [width, height]")
+
+
+class TemplateRegistry():
+    """ All templates of a folder, parsed once and indexed by id and by number of pictures.
+    A file is parsed again only when its mtime changes """
+
+    # minimum time between two checks of the template folder (seconds)
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(self, template_dir):
+        self.template_dir = template_dir
+        self.templates = {}     # template id > Template
+        self.by_count = {}      # number of pictures > list of Templates
+        self.errors = {}        # file name > error message of invalid templates
+        self.last_refresh = None
+
+    def refresh(self, force=False):
+        """ parse new or modified template files and forget deleted ones """
+
+        now = time.monotonic()
+        if not force and self.last_refresh is not None and now - self.last_refresh < self.REFRESH_INTERVAL:
+            return
+        self.last_refresh = now
+
+        templates = {}
+        errors = {}
+        try:
+            entries = list(os.scandir(self.template_dir))
+        except OSError:
+            entries = []
+
+        for entry in entries:
+            match = TEMPLATE_NAME.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+
+            template_id = entry.name[:-5]
+            mtime = entry.stat().st_mtime_ns
+
+            # unchanged since last parsed
+            known = self.templates.get(template_id)
+            if known and known.mtime == mtime:
+                templates[template_id] = known
+                continue
+
+            try:
+                with open(entry.path) as f:
+                    layout = json.load(f)
+                validate_layout(layout, int(match.group(1)))
+            except (OSError, ValueError) as e:
+                errors[entry.name] = str(e)
+                if self.errors.get(entry.name) != str(e):
+                    print(f"Invalid template {entry.name} > Ignored: {e}")
+                continue
+
+            templates[template_id] = Template(template_id, entry.path, mtime, layout)
+
+        # rebuild the picture count index
+        by_count = {}
+        for template_id in sorted(templates):
+            by_count.setdefault(templates[template_id].pic_nb, []).append(templates[template_id])
+
+        self.templates, self.by_count, self.errors = templates, by_count, errors
+
+    def get(self, template_id):
+        """ template by id (e.g. T_06_01), None if not found or invalid """
+        self.refresh()
+        return self.templates.get(template_id)
+
+    def for_count(self, pic_nb):
+        """ all templates for a number of pictures, sorted by id """
+        self.refresh()
+        return self.by_count.get(pic_nb, [])
+
+    def resolve(self, template_id, pic_nb):
+        """ the requested template if it matches the number of pictures, the first matching one otherwise, None if there is none """
+
+        template = self.get(template_id)
+        if template and template.pic_nb == pic_nb:
+            return template
+
+        matching_templates = self.for_count(pic_nb)
+        return matching_templates[0] if matching_templates else None
+
+    def all(self):
+        """ all valid templates, sorted by id """
+        self.refresh()
+        return [self.templates[template_id] for template_id in sorted(self.templates)]
+
+
+# one registry per template folder and per process
+_registries = {}
+
+
+def get_registry(template_dir):
+    """ process-wide registry of a template folder """
+
+    template_dir = os.path.normpath(template_dir)
+    if template_dir not in _registries:
+        _registries[template_dir] = TemplateRegistry(template_dir)
+    return _registries[template_dir]
@@ -2,13 +2,21 @@ from PyQt5.QtCore import QObject, QThread, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QDialog, QFileDialog
 from PyQt5.QtGui import QIcon
 from PIL import Image, ImageDraw, ImageFont
+from edit import *
 from core import *
+from batch import BatchJob, build_job, make_names_unique
+from pipeline import BatchRenderer
+from scheduler import format_duration, memory_budget
+from watcher import FolderWatcher
+from jobqueue import JobQueue
+from framing import folder_framing
+from metadata import order_pictures
+from template_registry import get_registry
+from folder_index import get_folder_index
 import sys
 from datetime import datetime
-from random import randint
 import re
 import json
-from time import sleep
 import re
 
 # local paths
@@ -17,52 +25,86 @@ settings_json_path = 'settings.json'
 
 
 class LiveModeWorker(QObject):
-    """" Live Mode worker Class processing collages on a different thread """
+    """" Live Mode worker Class watching the root folder(s) and queuing collages on a different thread """
 
     finished = pyqtSignal()
-    progress = pyqtSignal(int)
+    progress = pyqtSignal(str)
+    collage_done = pyqtSignal(str, str, str)
     
-    def __init__(self, ui, parent=None):
+    def __init__(self, ui, roots, fields, parent=None):
         super().__init__(parent)
         self.ui = ui
+        self.roots = roots
+        # snapshot of the UI fields, replaced by the GUI thread when they change (see batch.build_job)
+        self.fields = fields
+
+    def report(self, job, result):
+        """ job queue callback, runs on a pool thread: only emit signals from here """
+        self.collage_done.emit(job.folder, str(result), result.save_path if job.show and result.ok else '')
 
     def run(self):
         ''' Thread function running at start '''
 
-        # The loop will only run in LiveMode and with a valid root folder
-        while self.ui.current_mode == 'live_mode' and os.path.isdir(self.ui.root_path_lineEdit.text()):
-            
-            # get list of available folders in root, ignore starting with '_'
-            dir_list = [dir for dir in os.listdir(self.ui.root_path_lineEdit.text()) if not dir.startswith('_')]
-
-            # if new folder available, update folder list and set latest one as active folder
-            if len(dir_list) > self.ui.active_folder_comboBox.count():
-                
-                # find new folder that is not part of the active_folder list
-                new_dir = ""
-                for dir in dir_list:
-                    if self.ui.active_folder_comboBox.findText(dir) == -1:
-                        new_dir = dir
-                        break
-                
-                self.ui.update_folders()
-                self.ui.active_folder_comboBox.setCurrentText(new_dir)
-
-                # timer to ensure that all pictures have entered
-                sleep(3)
-                self.progress.emit(f"New folder found: Creating Collage for {new_dir}")
-                self.ui.create_collage_image()
-            
-            # update comboBox in case a folder is deleted
-            elif len(dir_list) < self.ui.active_folder_comboBox.count():
-                self.ui.update_folders(self)
-            
-            # timer to wait before checking for a new folder
-            sleep(3)
-        
+        # filesystem events (inotify) when available, polling otherwise
+        watcher = FolderWatcher(self.roots, SETTINGS['PIC_EXTENSION'], quiet_time=SETTINGS.get('LIVE_QUIET_TIME', 2.0),
+                                depth=SETTINGS.get('LIVE_DEPTH', 1), backend=SETTINGS.get('LIVE_WATCHER', 'auto'),
+                                report_existing=SETTINGS.get('SKIP_UNCHANGED', False))
+        self.progress.emit(f"Live Mode: watching {', '.join(self.roots)} ({watcher.backend_name})")
+
+        # new folders are rendered in parallel by a pool of processes, without touching any widget
+        queue = JobQueue(SETTINGS.get('LIVE_PROCESSES', 0), SETTINGS.get('LIVE_MAX_PENDING', 0), on_done=self.report, depth=SETTINGS.get('PIPELINE_DEPTH', 2),
+                         metrics_file=SETTINGS.get('METRICS_FILE', ''), profile_dir=SETTINGS.get('PROFILE_DIR', ''),
+                         profile_top=SETTINGS.get('PROFILE_TOP', 20), memory_budget=memory_budget(SETTINGS))
+
+        # The loop will only run in LiveMode
+        while self.ui.current_mode == 'live_mode':
+
+            # folders are only reported once their pictures stopped changing for LIVE_QUIET_TIME seconds
+            for folder in watcher.wait(timeout=1.0):
+                job = build_job(folder, **self.fields)
+                if not job.pictures:
+                    self.progress.emit(f"Pictures not found for batch {os.path.basename(folder)}")
+                    continue
+                self.progress.emit(f"Folder found: Creating Collage for {folder}")
+                # blocks while the queue is full (backpressure), new events wait in the watcher meanwhile
+                while not queue.submit(job, timeout=1.0) and self.ui.current_mode == 'live_mode':
+                    pass
+
+        # finish the collages being rendered, drop the queued ones
+        queue.close()
+        watcher.close()
         self.finished.emit()
 
-        
+
+class BatchWorker(QObject):
+    """ Batch Mode worker Class rendering collages in a process pool from a different thread """
+
+    finished = pyqtSignal()
+    progress = pyqtSignal(str)
+
+    def __init__(self, jobs, parent=None):
+        super().__init__(parent)
+        self.jobs = jobs
+
+    def report(self, done, total, result, eta):
+        """ forward each finished job to the UI """
+        self.progress.emit(f"[{done}/{total}] {result}" + (f" | ETA {format_duration(eta)}" if done < total else ''))
+
+    def run(self):
+        ''' Thread function running at start '''
+
+        results = BatchRenderer().run(self.jobs, self.report)
+
+        # open collages once rendered, as the serial path does
+        for job, result in zip(self.jobs, results):
+            if job.show and result.ok:
+                os.startfile(result.save_path)
+
+        failed = len([result for result in results if not result.ok])
+        self.progress.emit(f"Batch done: {len(results) - failed} collage(s) created, {failed} failed")
+        self.finished.emit()
+
+
 class CocoUI(QDialog):
     """ Main UI dialog """
 
@@ -312,8 +354,7 @@ class CocoUI(QDialog):
 
         # TEMPLATES
         self.template_folder = os.path.join(sys.path[0], SETTINGS['TEMPLATE_DIR'])
-        self.template_files = [t for t in os.listdir(self.template_folder) if t.lower().endswith('.json')]
-        self.template_previews = [t for t in os.listdir(self.template_folder) if t.lower().endswith('.png') or t.lower().endswith('.jpg')]
+        self.template_registry = get_registry(SETTINGS['TEMPLATE_DIR'])
         self.templates_comboBox.setGeometry(QtCore.QRect(420, 330, 540, 25))
         self.template_label.setGeometry(QtCore.QRect(420, 20, 540, 300)) # template picture
         self.init_template()
@@ -370,6 +411,13 @@ class CocoUI(QDialog):
         self.help_button.clicked.connect(self.open_documentation)
         self.settings_button.clicked.connect(self.open_settings)
 
+        # keep the Live Mode worker's snapshot of the fields up to date
+        for signal in (self.titel_lineEdit.textChanged, self.subtitle_lineEdit.textChanged, self.time_lineEdit.textChanged,
+                       self.notes_lineEdit.textChanged, self.export_folder_lineEdit.textChanged, self.export_picture_lineEdit.textChanged,
+                       self.selected_pictures_textEdit.textChanged, self.templates_comboBox.activated,
+                       self.open_collage_checkBox.toggled, self.display_description_checkBox.toggled, self.display_logo_checkbox.toggled):
+            signal.connect(self.update_live_fields)
+
         # save current scan settings
         self.store_current_values()
 
@@ -425,8 +473,8 @@ class CocoUI(QDialog):
                 self.print_to_log("Root path invalid")
                 return
 
-        # load all subfolders which dont start with an underscore
-        self.active_folders = [folder for folder in sorted(os.listdir(root_path)) if not folder.startswith('_')]
+        # load all subfolders which dont start with an underscore (listing cached until the root folder changes)
+        self.active_folders = [folder for folder in get_folder_index().subfolders(root_path) if not folder.startswith('_')]
         
         # check if there is at least one session folder
         if not self.active_folders:
@@ -481,8 +529,8 @@ class CocoUI(QDialog):
     def init_template(self):
         """ init the templates combo box and set up the default one at startup """
 
-        for template in self.template_files:
-            self.templates_comboBox.addItem(f"{template}  |  Images: {int(template.split('_')[1])}  |  Template: {int(template.split('_')[2][:-5])}")
+        for template in self.template_registry.all():
+            self.templates_comboBox.addItem(f"{template.template_id}.json  |  Images: {template.pic_nb}  |  Template: {template.variant}")
         
         self.current_template = SETTINGS['TEMPLATE_DEFAULT']
         self.templates_comboBox.setCurrentIndex(self.templates_comboBox.findText(self.current_template, QtCore.Qt.MatchStartsWith))
@@ -525,44 +573,12 @@ class CocoUI(QDialog):
     def create_template_preview(self):
         """ generate a preview of the current template """
 
-        # load template file contents and store information
-        with open(f"{os.path.join(SETTINGS['TEMPLATE_DIR'], self.current_template)}.json") as f:
-            template_layout = json.load(f)
-        template_layout['Description'] = template_layout['Description'][:-1]
-
-        # create empty picture
-        template_img_width = SETTINGS['COLLAGE_WIDTH']
-        template_img_height = SETTINGS['COLLAGE_HEIGHT']
-        template_img = Image.new(mode="RGB", size=(template_img_width, template_img_height), color=tuple(SETTINGS['BKG_COLOR']))
-
-        # draw pictures/description/logo positions
-        for key, value in template_layout.items():
-            # data missing or not specified
-            if not (key and value):
-                continue
-            
-            pic_x, pic_y, pic_w, pic_h = value[0:4]
-            grey_value = randint(0, 128)  # get random grey value btw 0 and 128 (dark)
-            pic_clr = grey_value, grey_value, grey_value  # convert to RGB
-            frame_color = 255, 255, 255
-            frame_width = 3
-
-            sub_img = Image.new(mode="RGBA", size=(pic_w, pic_h), color=pic_clr)
-            template_img.paste(sub_img, box=(pic_x, pic_y), mask=sub_img)
-            # add white frame
-            border = ImageDraw.Draw(template_img)
-            border.rectangle([pic_x, pic_y, pic_x + pic_w, pic_y + pic_h], fill=None, outline=frame_color, width=frame_width)
-            # add pic number
-            description = ImageDraw.Draw(template_img)
-            description.text((pic_x + 10, pic_y + 10), key, font=ImageFont.truetype(SETTINGS['TEXT_FONT'], 50), fill=tuple(SETTINGS['TEXT_COLOR']))
-        
-        # draw picture frame
-        border = ImageDraw.Draw(template_img)
-        border.rectangle([0,0,template_img_width - frame_width, template_img_height - frame_width], fill=None, outline=frame_color, width=frame_width)
+        # draw the template boxes at the collage size
+        template_img = draw_template_preview(self.template_registry.get(self.current_template))
 
         # resize and save picture
         size = self.template_label.width(), self.template_label.height()
-        template_img.thumbnail(size, Image.ANTIALIAS)
+        template_img.thumbnail(size, Image.LANCZOS)
         template_img_path = f"{os.path.join(SETTINGS['TEMPLATE_DIR'], self.current_template)}.jpg"
         template_img.save(template_img_path)
 
@@ -700,11 +716,17 @@ class CocoUI(QDialog):
     def start_live_mode(self):
         """ start thread handling live mode """
 
+        # watch the root folder and any additional root from the settings
+        roots = [root for root in [self.root_path_lineEdit.text()] + SETTINGS.get('LIVE_ROOTS', []) if root and os.path.isdir(root)]
+        if not roots:
+            self.print_to_log("Live Mode: no valid root folder to watch")
+            return
+
         # Create a QThread object
         self.thread = QThread()
 
         # Create a LiveModeWorker object
-        self.live_mode_worker = LiveModeWorker(self)
+        self.live_mode_worker = LiveModeWorker(self, roots, self.get_job_fields())
 
         # Move worker to the thread
         self.live_mode_worker.moveToThread(self.thread)
@@ -715,6 +737,7 @@ class CocoUI(QDialog):
         self.live_mode_worker.finished.connect(self.live_mode_worker.deleteLater)
         self.thread.finished.connect(self.thread.deleteLater)
         self.live_mode_worker.progress.connect(self.lm_thread_reportProgress)
+        self.live_mode_worker.collage_done.connect(self.live_collage_done)
 
         # Start the thread
         self.thread.start()
@@ -722,7 +745,64 @@ class CocoUI(QDialog):
 
     def lm_thread_reportProgress(self, n):
         """ add here any report progress from the liveMode thread """
-        pass
+        self.print_to_log(n)
+
+
+    def get_job_fields(self):
+        """ snapshot of the fields and options needed to build a job for any folder (see batch.build_job) """
+
+        edit_mode, open_collage, add_description, add_logo = self.get_options()
+        quality = SETTINGS.get('LIVE_RESAMPLE_QUALITY', 'fast') if self.current_mode == 'live_mode' else SETTINGS.get('RESAMPLE_QUALITY', 'high')
+
+        return dict(template=self.current_template, title=self.titel_lineEdit.text(), subtitle=self.subtitle_lineEdit.text(),
+                    Time=self.time_lineEdit.text(), notes=self.notes_lineEdit.toPlainText(),
+                    export_dir=self.export_folder_lineEdit.text(), picture_name=self.export_picture_lineEdit.text(),
+                    pictures=self.selected_pictures_textEdit.toPlainText().splitlines(),
+                    show=open_collage, desc=add_description, logo=add_logo, quality=quality,
+                    skip_unchanged=SETTINGS.get('SKIP_UNCHANGED', False))
+
+
+    def update_live_fields(self, *args):
+        """ send the current fields to the Live Mode worker """
+        if self.current_mode == 'live_mode' and getattr(self, 'live_mode_worker', None):
+            self.live_mode_worker.fields = self.get_job_fields()
+
+
+    def live_collage_done(self, folder, message, open_path):
+        """ Live Mode collage rendered, runs on the GUI thread """
+
+        self.print_to_log(message)
+
+        # select the new folder if it is part of the root
+        if os.path.normpath(os.path.dirname(folder)) == os.path.normpath(self.root_path_lineEdit.text()):
+            self.update_folders()
+            self.active_folder_comboBox.setCurrentText(os.path.basename(folder))
+
+        if open_path:
+            os.startfile(open_path)
+
+
+    def start_batch(self, jobs):
+        """ start thread rendering batch jobs in parallel """
+
+        self.create_button.setEnabled(False)
+
+        # Create a QThread object and a BatchWorker object, move worker to the thread
+        self.batch_thread = QThread()
+        self.batch_worker = BatchWorker(jobs)
+        self.batch_worker.moveToThread(self.batch_thread)
+
+        # Connect signals and slots
+        self.batch_thread.started.connect(self.batch_worker.run)
+        self.batch_worker.finished.connect(self.batch_thread.quit)
+        self.batch_worker.finished.connect(self.batch_worker.deleteLater)
+        self.batch_thread.finished.connect(self.batch_thread.deleteLater)
+        self.batch_thread.finished.connect(lambda: self.create_button.setEnabled(self.current_mode != 'live_mode'))
+        self.batch_worker.progress.connect(self.print_to_log)
+
+        # Start the thread
+        self.print_to_log(f"Rendering {len(jobs)} batch(es)")
+        self.batch_thread.start()
 
 
     def get_export_folder(self):
@@ -767,7 +847,7 @@ class CocoUI(QDialog):
         pic_name = re.sub('[^\w_.)( -]', '_', pic_name)
 
         # make sure picture is unique
-        if os.path.isfile(os.path.join(self.export_folder, f'{pic_name}.png')):
+        if os.path.isfile(os.path.join(self.export_folder, f'{pic_name}{output_extension(get_output_format(SETTINGS))}')):
             pic_name = f'{pic_name}_{datetime.now().strftime("%d.%m.%Y, %H:%M:%S")}'
         
         return pic_name
@@ -799,16 +879,20 @@ class CocoUI(QDialog):
         if self.selected_pictures_textEdit.toPlainText():
             pictures_list = [os.path.split(pic)[-1] for pic in self.selected_pictures_textEdit.toPlainText().splitlines() if pic]
         else:
-            pictures_list = [os.path.split(pic)[-1] for pic in os.listdir(active_path) if pic.lower()[-4:] in SETTINGS['PIC_EXTENSION']]
+            pictures_list = get_folder_index().pictures(active_path, SETTINGS['PIC_EXTENSION'])
 
         # make list of valid pictures path
         for picture in pictures_list:
             picture_path = os.path.normpath(os.path.join(active_path, picture))
-            if os.path.isfile(picture_path):
+            if get_folder_index().is_file(picture_path):
                 pictures_path.append(picture_path)
             else:
                 self.print_to_log(f"{picture} not valid > Removed from list.")
 
+        # folder pictures sorted by name or capture time, specified ones keep their order
+        if not self.selected_pictures_textEdit.toPlainText():
+            pictures_path = order_pictures(pictures_path, SETTINGS.get('PICTURE_ORDER', 'name'))
+
         return pictures_path
 
 
@@ -850,6 +934,9 @@ class CocoUI(QDialog):
             if os.path.isdir(active_folder):
                 processed_folders.append(active_folder)
         
+        # batch jobs are collected here and rendered in parallel once all fields have been read
+        batch_jobs = []
+
         # ALL MODSES / Process folder(s)
         for folder in processed_folders:
 
@@ -875,19 +962,34 @@ class CocoUI(QDialog):
             # get options
             edit_mode, open_collage, add_description, add_logo = self.get_options()
 
+            # Live Mode favours speed, exports from the other modes keep the high quality resampling
+            quality = SETTINGS.get('LIVE_RESAMPLE_QUALITY', 'fast') if self.current_mode == 'live_mode' else SETTINGS.get('RESAMPLE_QUALITY', 'high')
+
+            # BATCH MODE: defer rendering to the process pool
+            if self.current_mode == 'batch_mode':
+                batch_jobs.append(BatchJob(folder=self.active_path, pictures=processed_pictures, template=self.current_template,
+                                           title=title, subtitle=subtitle, Time=Time, notes=notes, export_dir=export_dir,
+                                           picture_name=pic_name, show=open_collage, desc=add_description, logo=add_logo, quality=quality,
+                                           skip_unchanged=SETTINGS.get('SKIP_UNCHANGED', False), framing=folder_framing(self.active_path, SETTINGS),
+                                           keep_order=bool(self.selected_pictures_textEdit.toPlainText())))
+                continue
+
             # creates new collage
-            new_collage = Collage(root='', title=title, subtitle=subtitle, Time=Time, notes=notes, path=self.active_path, pic_list=processed_pictures)
+            new_collage = Collage(root='', title=title, subtitle=subtitle, Time=Time, notes=notes, path=self.active_path, pic_list=processed_pictures, keep_order=bool(self.selected_pictures_textEdit.toPlainText()))
 
-            # generates template. Will raise an error if a matching template is not found (exit function in that case)
+            # generates template, or a generated layout if none matches. Will raise an error if it cannot be laid out (exit function in that case)
             try:
                 new_collage_dic = new_collage.generate_template(self.current_template)
-            except:
-                self.print_to_log(f"ERROR: Could not find a matching template for {len(processed_pictures)} pictures, please create one")
+            except Exception as e:
+                self.print_to_log(f"ERROR: Could not lay out {len(processed_pictures)} pictures: {e}")
                 return
 
             # creates and save picture (passing the mainWindow as argument to populate it in the UI file)
             self.mainWindow = Window()
-            new_collage.create_collage(self.app, self.mainWindow, pic_dic=new_collage_dic, ui=edit_mode, dir = export_dir, name = pic_name, show = open_collage, desc=add_description, logo=add_logo)
+            new_collage.create_collage(self.app, self.mainWindow, pic_dic=new_collage_dic, ui=edit_mode, dir = export_dir, name = pic_name, show = open_collage, desc=add_description, logo=add_logo, quality=quality, framing=folder_framing(self.active_path, SETTINGS))
+
+        if batch_jobs:
+            self.start_batch(make_names_unique(batch_jobs))
 
 
     def print_to_log(self, string):
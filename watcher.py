@@ -0,0 +1,224 @@
+from folder_index import get_folder_index
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_ignored(name):
+    """ folders and files starting with '_' (e.g. _out) or '.' are never watched """
+    return name.startswith('_') or name.startswith('.')
+
+
+class InotifyBackend():
+    """ Linux inotify events, read through ctypes. Reports the directories in which something changed """
+
+    def __init__(self, roots, depth):
+        self.depth = depth
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}  # watch descriptor > (directory, depth)
+        self.overflow = False
+        for root in roots:
+            self.add_watch(root, 0)
+
+    def add_watch(self, path, depth):
+        """ watch a directory and its subdirectories down to the maximum depth """
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            return
+        self.watches[wd] = path, depth
+
+        if depth < self.depth:
+            try:
+                subdirs = [os.path.join(path, name) for name in get_folder_index().subfolders(path) if not is_ignored(name)]
+            except OSError:
+                subdirs = []
+            for subdir in subdirs:
+                self.add_watch(subdir, depth + 1)
+
+    def read(self, timeout):
+        """ wait up to timeout for events, returns the set of changed directories and whether a rescan is needed """
+
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed, False
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed, False
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            name = os.fsdecode(name)
+            offset += EVENT_HEADER.size + length
+
+            # events were lost, the caller has to rescan
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if wd not in self.watches or not name or is_ignored(name):
+                continue
+
+            directory, depth = self.watches[wd]
+            path = os.path.join(directory, name)
+
+            # new folder: watch it, it may already contain pictures
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and depth < self.depth:
+                self.add_watch(path, depth + 1)
+                changed.add(path)
+
+            changed.add(directory)
+
+        overflow, self.overflow = self.overflow, False
+        return changed, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend():
+    """ Fallback for systems without inotify: compares directory snapshots (names, sizes, mtimes).
+    Unchanged directories cost a single stat per poll (see folder_index). Directories that changed in the last
+    `settle` seconds are fully listed on each poll, to follow the files still being written in them """
+
+    def __init__(self, roots, depth, interval=1.0, settle=5.0):
+        self.roots = roots
+        self.depth = depth
+        self.interval = interval
+        self.settle = settle
+        self.active = {}  # directory > time of its last change
+        self.snapshots = self.snapshot()
+
+    def snapshot(self):
+        """ {directory: signature of its entries} for all directories down to the maximum depth """
+
+        index = get_folder_index()
+        snapshots = {}
+        stack = [(root, 0) for root in self.roots]
+        while stack:
+            directory, depth = stack.pop()
+            try:
+                listing = index.listing(directory, force=directory in self.active)
+            except OSError:
+                continue
+            signature = [(name, -1, 0) for name in listing.folders if not is_ignored(name)]
+            signature += [(name, *stat) for name, stat in listing.files.items() if not is_ignored(name)]
+            if depth < self.depth:
+                stack += [(os.path.join(directory, name), depth + 1) for name in listing.folders if not is_ignored(name)]
+            snapshots[directory] = frozenset(signature)
+        return snapshots
+
+    def read(self, timeout):
+        """ wait up to timeout, returns the set of changed directories """
+
+        time.sleep(min(timeout, self.interval))
+        snapshots = self.snapshot()
+        changed = {directory for directory, signature in snapshots.items() if self.snapshots.get(directory) != signature}
+        self.snapshots = snapshots
+
+        now = time.monotonic()
+        self.active.update({directory: now for directory in changed})
+        self.active = {directory: changed_time for directory, changed_time in self.active.items() if now - changed_time < self.settle}
+        return changed, False
+
+    def close(self):
+        pass
+
+
+class FolderWatcher():
+    """ Watches one or more root folders and reports collage folders (subfolders containing pictures, down to depth)
+    once their files have stopped changing for quiet_time seconds.
+    Folders existing at start are only reported with report_existing (e.g. to catch up after a restart) """
+
+    def __init__(self, roots, extensions, quiet_time=2.0, depth=1, backend='auto', poll_interval=1.0, report_existing=False):
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.extensions = [ext.lower() for ext in extensions]
+        self.quiet_time = quiet_time
+        self.depth = max(depth, 1)
+        self.pending = {}  # folder > time of its last change
+        self.started = time.time()
+
+        self.backend = None
+        if backend in ('auto', 'inotify') and sys.platform.startswith('linux'):
+            try:
+                self.backend = InotifyBackend(self.roots, self.depth)
+            except (OSError, AttributeError):
+                self.backend = None
+        if self.backend is None:
+            self.backend = PollingBackend(self.roots, self.depth, poll_interval, settle=max(quiet_time * 2, 5.0))
+
+        # existing folders are handled like new ones, reported on the first wait() once quiet
+        if report_existing:
+            existing = PollingBackend(self.roots, self.depth).snapshots
+            self.pending.update({directory: time.monotonic() - self.quiet_time for directory in existing
+                                 if os.path.normpath(directory) not in self.roots})
+
+    @property
+    def backend_name(self):
+        return 'inotify' if isinstance(self.backend, InotifyBackend) else 'polling'
+
+    def has_pictures(self, folder):
+        """ True if the folder directly contains at least one supported picture """
+        return get_folder_index().has_pictures(folder, self.extensions)
+
+    def wait(self, timeout=1.0):
+        """ wait up to timeout for changes, returns the folders that have been quiet for long enough """
+
+        changed, overflow = self.backend.read(timeout)
+
+        # events were lost: consider every folder modified since the watcher started
+        if overflow:
+            changed |= {directory for directory, signature in PollingBackend(self.roots, self.depth).snapshots.items()
+                        if os.stat(directory).st_mtime >= self.started}
+
+        now = time.monotonic()
+        for directory in changed:
+            if os.path.normpath(directory) not in self.roots:
+                self.pending[directory] = now
+
+        # report folders which stopped changing
+        ready = []
+        for folder, last_change in list(self.pending.items()):
+            if now - last_change < self.quiet_time:
+                continue
+            del self.pending[folder]
+            if os.path.isdir(folder) and self.has_pictures(folder):
+                ready.append(folder)
+
+        return sorted(ready)
+
+    def close(self):
+        self.backend.close()